@@ -0,0 +1,155 @@
+import numpy as np
+
+# probe value plotted for each source, and the factor it is divided by
+sources = {'Bandwidth': ('bandwidth', 1024 * 1024), 'Connection Time': ('overhead', 1)}
+
+
+def probe_value(probes, source):
+    """
+    :param probes: ingest.load_archive probe columns
+    :param source: "Bandwidth" in Mbps or "Connection Time" in s
+    :return: array of the source value of every row, nan for failed probes
+    """
+    column, scale = sources[source]
+    return probes[column] / scale
+
+
+def overall_values(probes, source, directory):
+    """
+    sorted values of every successful probe, the input of the per location ECDF
+    :param probes: ingest.load_archive probe columns
+    :param source: "Bandwidth" or "Connection Time"
+    :param directory: list of locations
+    :return: dic {location : {f'{gateway}_gateway' : sorted array}}
+    """
+    data = {x: {'local_gateway': np.array([]), 'public_gateway': np.array([])} for x in directory}
+    if len(probes) == 0:
+        return data
+    value = probe_value(probes, source)
+    for location in directory:
+        at_location = (probes['location'] == location) & probes['ok']
+        for gateway in np.unique(probes['gateway'][at_location]):
+            data[location][f'{gateway}_gateway'] = np.sort(value[at_location & (probes['gateway'] == gateway)])
+    return data
+
+
+def reachability_counts(probes, directory):
+    """
+    successful probes per gateway, day and location
+    :param probes: ingest.load_archive probe columns
+    :param directory: list of locations
+    :return: dic {location : {date : {gateway : count}}}
+    """
+    data = {x: {} for x in directory}
+    if len(probes) == 0:
+        return data
+    gateways = np.unique(probes['gateway']).tolist()
+    for location in directory:
+        at_location = probes['location'] == location
+        dates, inverse = np.unique(probes['date'][at_location], return_inverse=True)
+        ok = probes['ok'][at_location]
+        gateway = probes['gateway'][at_location]
+        counts = {x: np.bincount(inverse[ok & (gateway == x)], minlength=len(dates)) for x in gateways}
+        for i, date in enumerate(dates.tolist()):
+            data[location][date] = {x: int(counts[x][i]) for x in gateways}
+    return data
+
+
+def video_table(probes, mask, local='local', public='public'):
+    """
+    one row per video of the masked probe rows, with the local and public probe side by side
+    :param probes: ingest.load_archive probe columns
+    :param mask: probe rows of one location
+    :param local: local gateway name
+    :param public: public gateway name
+    :return: dic {"date", "cid", "local_ok", "public_ok": arrays, "local", "public": row index of the probe or -1}
+    """
+    rows = np.nonzero(mask)[0]
+    # rows of a video are next to each other in file order
+    key_change = np.ones(len(rows), dtype=bool)
+    key_change[1:] = (probes['date'][rows][1:] != probes['date'][rows][:-1]) | \
+                     (probes['index'][rows][1:] != probes['index'][rows][:-1])
+    video = np.cumsum(key_change) - 1
+    count = int(video[-1]) + 1 if len(rows) > 0 else 0
+    table = {'date': probes['date'][rows][key_change], 'cid': probes['cid'][rows][key_change]}
+    for name, gateway in (('local', local), ('public', public)):
+        row = np.full(count, -1)
+        is_gateway = probes['gateway'][rows] == gateway
+        row[video[is_gateway]] = rows[is_gateway]
+        table[name] = row
+        table[f'{name}_ok'] = (row >= 0) & probes['ok'][np.maximum(row, 0)]
+    return table
+
+
+def grouped_mean(values, groups, count):
+    """
+    :param values: array of values
+    :param groups: group index of each value
+    :param count: number of groups
+    :return: mean of each group, nan for an empty group
+    """
+    total = np.bincount(groups, weights=values, minlength=count)
+    size = np.bincount(groups, minlength=count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / size
+
+
+def continues_means(probes, source, directory):
+    """
+    daily mean of the source for the videos reachable on the local gateway the first day, on the local and
+    public gateway, and of the public gateway for the rest of the videos
+    :param probes: ingest.load_archive probe columns
+    :param source: "Bandwidth" or "Connection Time"
+    :param directory: list of locations
+    :return: dic {location : {date : {"local": mean, "public": mean, "rest": mean}}}
+    """
+    vid_data = {x: {} for x in directory}
+    if len(probes) == 0:
+        return vid_data
+    value = probe_value(probes, source)
+    for location in directory:
+        table = video_table(probes, probes['location'] == location)
+        if len(table['date']) == 0:
+            continue
+        dates, day = np.unique(table['date'], return_inverse=True)
+        # find all cid with local data the first day
+        first_day = table['date'] == table['date'][0]
+        local_reachable_cids = np.unique(table['cid'][first_day & table['local_ok']])
+        tracked = np.isin(table['cid'], local_reachable_cids) & table['local_ok']
+        rest = ~tracked & table['public_ok']
+        local_value = value[table['local']]
+        public_value = value[table['public']]
+        # a tracked video without public probe has no public value
+        public_tracked = tracked & table['public_ok']
+        local_mean = grouped_mean(local_value[tracked], day[tracked], len(dates))
+        public_mean = grouped_mean(public_value[public_tracked], day[public_tracked], len(dates))
+        rest_mean = grouped_mean(public_value[rest], day[rest], len(dates))
+        for i, date in enumerate(dates.tolist()):
+            vid_data[location][date] = {'local': local_mean[i], 'public': public_mean[i], 'rest': rest_mean[i]}
+    return vid_data
+
+
+def provider_stats(hop_dic):
+    """
+    :param hop_dic: {location : hop summary list}
+    :return: provider count per cid, rtt of each distinct ip and the distinct ip, each {location : list}
+    """
+    provider_data = {}
+    rtt_data = {}
+    ip_data = {}
+    for location, ip_info in hop_dic.items():
+        provider_data[location] = np.sort([len(x['providers']) for x in ip_info])
+        seen = set()
+        ip_data[location] = []
+        rtt_data[location] = []
+        for ip in ip_info:
+            for addresses in ip['providers'].values():
+                for address in addresses:
+                    if address['ip'] in seen:
+                        continue
+                    seen.add(address['ip'])
+                    ip_data[location].append(address['ip'])
+                    if address['rtt'] is not None:
+                        rtt_data[location].append(float(address['rtt']))
+        rtt_data[location] = np.sort(rtt_data[location])
+    return provider_data, rtt_data, ip_data
@@ -1,11 +1,12 @@
-import json
-import os
 import socket
 
 import numpy as np
 import matplotlib.pyplot as plt
 from geolite2 import geolite2
 
+import aggregate
+import ingest
+
 # global plot setting
 plt.rcParams['axes.labelsize'] = 14
 plt.rcParams['axes.titlesize'] = 16
@@ -42,60 +43,19 @@ def overall_cdf(data, cdf_type, x_label, save=False):
     plt.show()
 
 
-def continues_graph(data, source, y_label, save=False):
+def continues_graph(vid_data, source, y_label, save=False):
     """
     plot a longest local reachable vid and compare the bw for local gateway and public gateway
     :param y_label: y label text
     :param source: data type needs to graph
     :param save: true for output fig false for show only
-    :param data: daily record for all location = dic { location {date : [vid_info]}}
+    :param vid_data: daily means for all location = aggregate.continues_means
+                     dic {location : {date : {"local": , "public": , "rest": }}}
     :return: None
     """
-    vid_data = {}
-    for location, date_data in data.items():
-        if location not in vid_data:
-            vid_data[location] = {}
-        # get first day data
-        first_date = list(date_data.keys())[0]
-        first_date_data = date_data[first_date]
-        # find all cid with local data
-        local_reachable_cids = []
-        for vid in first_date_data:
-            if vid['local_data'] is not None:
-                local_reachable_cids.append(vid['cid'])
-        # trace everyday
-        for date, daily_data in date_data.items():
-            daily_temp_data = {}
-            daily_temp_local = []
-            daily_temp_public = []
-            daily_temp_rest = []
-            for vid in daily_data:
-                if vid['cid'] in local_reachable_cids and vid['local_data'] is not None:
-                    # print(f'{location} {date} {vid["cid"]}')
-                    if source == 'Bandwidth':
-                        daily_temp_local.append(float(vid['local_data']['bandwidth']) / (1024 * 1024))
-                        daily_temp_public.append(float(vid['public_data']['bandwidth']) / (1024 * 1024))
-                    elif source == 'Connection Time':
-                        daily_temp_local.append(float(vid['local_data']['overhead']))
-                        daily_temp_public.append(float(vid['public_data']['overhead']))
-                elif vid['public_data'] is not None:
-                    if source == 'Bandwidth':
-                        daily_temp_rest.append(float(vid['public_data']['bandwidth']) / (1024 * 1024))
-                    elif source == 'Connection Time':
-                        daily_temp_rest.append(float(vid['public_data']['overhead']))
-            if len(daily_temp_local) > 0:
-                daily_temp_data['local'] = np.mean(daily_temp_local)
-            else:
-                daily_temp_data['local'] = float('nan')
-            if len(daily_temp_public) > 0:
-                daily_temp_data['public'] = np.mean(daily_temp_public)
-            else:
-                daily_temp_data['public'] = float('nan')
-            daily_temp_data['rest'] = np.mean(daily_temp_rest)
-            vid_data[location][date] = daily_temp_data
     # plot graph
     fig, ax = plt.subplots(figsize=(11, 10))
-    x_data = list(data['NY'].keys())
+    x_data = list(vid_data['NY'].keys())
     x_data.sort()
     public_compare_data = {}
     for location, video_source_data in vid_data.items():
@@ -175,6 +135,9 @@ def summary_graph(data, save=False):
     for date, summary_data in data.items():
         x_data.append(date)
         for vid_type, vid_data in summary_data.items():
+            if vid_type == 'failed_feeds':
+                # feeds left at zero because they could not be fetched that day
+                continue
             for vid_source, vid_count in vid_data.items():
                 if vid_source == 'total_video':
                     continue
@@ -231,112 +194,33 @@ def main():
     save_file = True
     # trace though dir
     directory = ['NY', 'CA', 'EU', 'JP']
-    #  dic : {date : data}
-    summary_dic = {'NY': {}, 'CA': {}, 'EU': {}, 'JP': {}}
-    daily_dic = {'NY': {}, 'CA': {}, 'EU': {}, 'JP': {}}
-    all_vid_dic = {'NY': {}, 'CA': {}, 'EU': {}, 'JP': {}}
-    hop_dic = {'NY': {}, 'CA': {}, 'EU': {}, 'JP': {}}
-    for path in directory:
-        for _, _, files in os.walk(path):
-            files.sort()
-            for file in files:
-                # load summary json
-                if "hop_summary" in file:
-                    # case of hop information
-                    with open(f'{path}/{file}') as fin:
-                        all_hop_data = json.load(fin)
-                    hop_dic[path] = all_hop_data
-                elif "summary" in file and "all_vid" not in file:
-                    index = file.find("summary")
-                    date = file[:index - 1]
-                    # print(f'Summary {date}')
-                    with open(f'{path}/{file}') as fin:
-                        summary_data = json.load(fin)
-                    summary_dic[path][date] = summary_data
-                elif "all_vid" in file:
-                    # case of full data
-                    with open(f'{path}/{file}') as fin:
-                        all_vid_data = json.load(fin)
-                    all_vid_dic[path] = all_vid_data
-                elif 'zip' not in file:
-                    # daily data
-                    index = file.find('.')
-                    date = file[:index]
-                    # print(f'Daily {date}')
-                    with open(f'{path}/{file}') as fin:
-                        daily_data = json.load(fin)
-                    daily_dic[path][date] = daily_data
+    # columns cached per file, only new or changed files are parsed
+    probes, summary_dic, all_vid_dic, hop_dic = ingest.load_archive(directory)
     # plot summary
     summary_graph(summary_dic['NY'], save=save_file)
     # plot duration cdf
     duration_data = {}
     for location, all_vid_info in all_vid_dic.items():
-        if location not in duration_data:
-            duration_data[location] = []
-        for _, vid_info in all_vid_info.items():
-            duration_data[location].append(float(vid_info['dur']) / 60)
-        duration_data[location].sort()
+        duration_data[location] = np.sort(all_vid_info['dur'] / 60)
     cdf_graph(duration_data, 'Video Duration', 'Duration (Min)', save=save_file)
     # plot overall cdf
-    overall_bw_data = {}
-    overall_overhead_data = {}
-    video_ratio_data = {}
-    for location, date_data in daily_dic.items():
-        if location not in overall_bw_data:
-            overall_bw_data[location] = {'local_gateway': [], 'public_gateway': []}
-        if location not in overall_overhead_data:
-            overall_overhead_data[location] = {'local_gateway': [], 'public_gateway': []}
-        if location not in video_ratio_data:
-            video_ratio_data[location] = {}
-        for date, daily_data in date_data.items():
-            video_ratio_data[location][date] = {'local': 0, 'public': 0}
-            for vid in daily_data:
-                if vid['local_data'] is not None:
-                    overall_bw_data[location]['local_gateway'].append(
-                        float(vid['local_data']['bandwidth']) / (1024 * 1024))
-                    overall_overhead_data[location]['local_gateway'].append(
-                        float(vid['local_data']['overhead']))
-                    video_ratio_data[location][date]['local'] += 1
-                if vid['public_data'] is not None:
-                    overall_bw_data[location]['public_gateway'].append(
-                        float(vid['public_data']['bandwidth']) / (1024 * 1024))
-                    overall_overhead_data[location]['public_gateway'].append(
-                        float(vid['public_data']['overhead']))
-                    video_ratio_data[location][date]['public'] += 1
-        overall_bw_data[location]['local_gateway'].sort()
-        overall_bw_data[location]['public_gateway'].sort()
-        overall_overhead_data[location]['local_gateway'].sort()
-        overall_overhead_data[location]['public_gateway'].sort()
+    overall_bw_data = aggregate.overall_values(probes, 'Bandwidth', directory)
+    overall_overhead_data = aggregate.overall_values(probes, 'Connection Time', directory)
+    video_ratio_data = aggregate.reachability_counts(probes, directory)
     # plot overall cdf
     overall_cdf(overall_bw_data, 'Bandwidth', 'Bandwidth (Mbps)', save=save_file)
     overall_cdf(overall_overhead_data, 'Connection Time', 'Connection Time (s)', save=save_file)
     # plot specific video bw and connection time
-    continues_graph(daily_dic, 'Bandwidth', 'Bandwidth (Mbps)', save=save_file)
-    continues_graph(daily_dic, 'Connection Time', 'Connection Time (s)', save=save_file)
+    continues_graph(aggregate.continues_means(probes, 'Bandwidth', directory), 'Bandwidth', 'Bandwidth (Mbps)',
+                    save=save_file)
+    continues_graph(aggregate.continues_means(probes, 'Connection Time', directory), 'Connection Time',
+                    'Connection Time (s)', save=save_file)
     # plot daily ratio graph
     daily_ratio_graph(video_ratio_data, save=save_file)
     # analysis ip info
-    provider_data = {}
-    rtt_data = {}
-    ip_data = {}
     for location, ip_info in hop_dic.items():
         print(f'{location} {len(ip_info)}')
-        provider_data[location] = []
-        rtt_data[location] = []
-        ip_data[location] = []
-        for ip in ip_info:
-            providers = ip['providers']
-            provider_data[location].append(len(providers.keys()))
-            for _, addresses in providers.items():
-                for address in addresses:
-                    ip_address = address['ip']
-                    if ip_address not in ip_data[location]:
-                        ip_data[location].append(ip_address)
-                        rtt = address['rtt']
-                        if rtt is not None:
-                            rtt_data[location].append(float(rtt))
-        provider_data[location].sort()
-        rtt_data[location].sort()
+    provider_data, rtt_data, ip_data = aggregate.provider_stats(hop_dic)
     # provider CDF
     cdf_graph(provider_data, 'Provider Count', 'Provider ID Count', save=save_file)
     # plot RTT CDF
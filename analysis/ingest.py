@@ -0,0 +1,178 @@
+import json
+import os
+
+import numpy as np
+
+# per file column caches and the whole archive, outside the location directories main walks
+cache_dir = '.cache'
+archive_file = 'archive.npz'
+# probe values kept from every {gateway}_data record
+probe_values = ['overhead', 'bandwidth', 'file_size']
+
+
+def file_kind(file):
+    """
+    :param file: file name in a location directory
+    :return: "hop", "summary", "all_vid", "daily" or None for an archive
+    """
+    if "hop_summary" in file:
+        return "hop"
+    elif "summary" in file and "all_vid" not in file:
+        return "summary"
+    elif "all_vid" in file:
+        return "all_vid"
+    elif 'zip' not in file:
+        return "daily"
+    return None
+
+
+def parse_daily(path, location, date):
+    """
+    flatten a {date}.json into one row per video and gateway
+    :param path: daily json path
+    :param location: vantage point
+    :param date: date string of the file
+    :return: dic {column : array}
+    """
+    with open(path) as fin:
+        daily_data = json.load(fin)
+    rows = {x: [] for x in ['index', 'cid', 'gateway', 'ok', 'dur', 'category'] + probe_values}
+    for index, vid in enumerate(daily_data):
+        for key, data in vid.items():
+            if not key.endswith('_data'):
+                continue
+            rows['index'].append(index)
+            rows['cid'].append(vid['cid'])
+            rows['gateway'].append(key[:-len('_data')])
+            rows['ok'].append(data is not None)
+            rows['dur'].append(float(vid['dur']) if vid.get('dur') is not None else np.nan)
+            rows['category'].append(vid.get('category') or '')
+            for value in probe_values:
+                rows[value].append(float(data[value]) if data is not None else np.nan)
+    columns = {
+        'location': np.full(len(rows['cid']), location),
+        'date': np.full(len(rows['cid']), date),
+        'index': np.array(rows['index'], dtype=np.int32),
+        'cid': np.array(rows['cid'], dtype=str),
+        'gateway': np.array(rows['gateway'], dtype=str),
+        'ok': np.array(rows['ok'], dtype=bool),
+        'dur': np.array(rows['dur'], dtype=np.float64),
+        'category': np.array(rows['category'], dtype=str),
+    }
+    for value in probe_values:
+        columns[value] = np.array(rows[value], dtype=np.float64)
+    return columns
+
+
+def parse_all_vid(path):
+    """
+    :param path: all_vid_summary.json path
+    :return: dic {"cid": array, "dur": array}
+    """
+    with open(path) as fin:
+        all_vid_data = json.load(fin)
+    return {'cid': np.array(list(all_vid_data.keys()), dtype=str),
+            'dur': np.array([float(x['dur']) for x in all_vid_data.values()], dtype=np.float64)}
+
+
+def cached_columns(path, parse, *args):
+    """
+    columns of a file from its npz cache, parsed again only when the file mtime or size changed
+    :param path: source file
+    :param parse: function path, *args -> dic {column : array}
+    :return: dic {column : array}
+    """
+    stat = os.stat(path)
+    cache_path = os.path.join(cache_dir, f'{path}.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if cache['_mtime'] == stat.st_mtime_ns and cache['_size'] == stat.st_size:
+                return {x: cache[x] for x in cache.files if not x.startswith('_')}
+    columns = parse(path, *args)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp = f'{cache_path}.tmp'
+    with open(temp, 'wb') as fout:
+        np.savez(fout, _mtime=stat.st_mtime_ns, _size=stat.st_size, **columns)
+    os.replace(temp, cache_path)
+    return columns
+
+
+def concat(parts):
+    """
+    :param parts: list of dic {column : array} with the same columns
+    :return: dic {column : array}, empty if parts is
+    """
+    if len(parts) == 0:
+        return {}
+    return {x: np.concatenate([part[x] for part in parts]) for x in parts[0]}
+
+
+def scan(directory):
+    """
+    :param directory: list of location directories
+    :return: list of (location, file name, kind, mtime, size) in the order main reads them
+    """
+    files = []
+    for path in directory:
+        for _, _, names in os.walk(path):
+            names.sort()
+            for file in names:
+                kind = file_kind(file)
+                if kind is None:
+                    continue
+                stat = os.stat(f'{path}/{file}')
+                files.append((path, file, kind, stat.st_mtime_ns, stat.st_size))
+    return files
+
+
+def load_archive(directory):
+    """
+    read every location directory the way analysis.main lays them out.
+    Everything is kept in one npz while no file changed, otherwise only the changed files are parsed again
+    :param directory: list of location directories
+    :return: probes {column : array} with one row per video, gateway and day in file order,
+             summary_dic {location : {date : summary}}, all_vid {location : {"cid": , "dur": }},
+             hop_dic {location : hop summary}
+    """
+    files = scan(directory)
+    manifest = json.dumps([directory, files])
+    archive_path = os.path.join(cache_dir, archive_file)
+    if os.path.exists(archive_path):
+        with np.load(archive_path) as cache:
+            if str(cache['_manifest']) == manifest:
+                rest = json.loads(str(cache['_rest']))
+                probes = {x[len('probe_'):]: cache[x] for x in cache.files if x.startswith('probe_')}
+                all_vid = {x: {'cid': cache[f'all_vid_cid_{x}'], 'dur': cache[f'all_vid_dur_{x}']}
+                           for x in directory}
+                return probes, rest['summary_dic'], all_vid, rest['hop_dic']
+    probe_parts = []
+    summary_dic = {x: {} for x in directory}
+    all_vid = {x: {'cid': np.array([], dtype=str), 'dur': np.array([])} for x in directory}
+    hop_dic = {x: {} for x in directory}
+    for path, file, kind, _, _ in files:
+        file_path = f'{path}/{file}'
+        if kind == "hop":
+            with open(file_path) as fin:
+                hop_dic[path] = json.load(fin)
+        elif kind == "summary":
+            index = file.find("summary")
+            with open(file_path) as fin:
+                summary_dic[path][file[:index - 1]] = json.load(fin)
+        elif kind == "all_vid":
+            all_vid[path] = cached_columns(file_path, parse_all_vid)
+        else:
+            date = file[:file.find('.')]
+            probe_parts.append(cached_columns(file_path, parse_daily, path, date))
+    probes = concat(probe_parts)
+    arrays = {f'probe_{x}': y for x, y in probes.items()}
+    for location in directory:
+        arrays[f'all_vid_cid_{location}'] = all_vid[location]['cid']
+        arrays[f'all_vid_dur_{location}'] = all_vid[location]['dur']
+    os.makedirs(cache_dir, exist_ok=True)
+    temp = f'{archive_path}.tmp'
+    with open(temp, 'wb') as fout:
+        np.savez(fout, _manifest=manifest, _rest=json.dumps({'summary_dic': summary_dic, 'hop_dic': hop_dic}),
+                 **arrays)
+    os.replace(temp, archive_path)
+    return probes, summary_dic, all_vid, hop_dic
+
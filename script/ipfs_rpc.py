@@ -0,0 +1,276 @@
+import http.client
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# kubo RPC api address
+rpc_host = "127.0.0.1"
+rpc_port = 5001
+# seconds between two replayed events of the stub server, 0 to send them at once
+replay_delay = 0.0
+
+# routing query event types of kubo
+SendingQuery = 0
+PeerResponse = 1
+FinalPeer = 2
+QueryError = 3
+Provider = 4
+Value = 5
+AddingPeer = 6
+DialingPeer = 7
+
+
+class IpfsRpcError(Exception):
+    pass
+
+
+class IpfsRpc:
+    """
+    kubo RPC client over one persistent http connection.
+    Streamed commands yield their ndjson events as they arrive, the connection is reused once a stream is drained.
+    A connection is not thread safe, use local_client() from worker threads
+    """
+
+    def __init__(self, host=None, port=None, timeout=None):
+        self.host = host if host is not None else rpc_host
+        self.port = port if port is not None else rpc_port
+        self.timeout = timeout
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _request(self, command, args, timeout=None):
+        """
+        send one api call, reconnect once if the kept connection was closed by the server
+        :param command: api command path, like dht/findprovs
+        :param args: list of (name, value) query parameters
+        :param timeout: socket timeout in seconds, self.timeout if None
+        :return: http.client.HTTPResponse with status 200
+        """
+        path = f'/api/v0/{command}?{urlencode(args)}'
+        if timeout is None:
+            timeout = self.timeout
+        for retry in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+            else:
+                self.conn.timeout = timeout
+                if self.conn.sock is not None:
+                    self.conn.sock.settimeout(timeout)
+            try:
+                self.conn.request('POST', path)
+                response = self.conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.close()
+                if retry == 1:
+                    raise
+        if response.status != 200:
+            body = response.read()
+            try:
+                message = json.loads(body)["Message"]
+            except Exception:
+                message = body.decode('utf-8', 'replace')
+            raise IpfsRpcError(f'{command} {response.status}: {message}')
+        return response
+
+    def stream(self, command, args, timeout=None):
+        """
+        :param command: api command path
+        :param args: list of (name, value) query parameters
+        :param timeout: socket timeout in seconds
+        :return: generator of decoded json objects, one per line of the response
+        """
+        response = self._request(command, args, timeout)
+        try:
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if len(line) > 0:
+                    yield json.loads(line)
+        except (GeneratorExit, Exception):
+            # stream left unread, the connection can not be reused
+            self.close()
+            raise
+
+    def findprovs(self, cid, timeout=None):
+        """
+        :param cid: cid to find providers of
+        :param timeout: seconds the node may spend on the lookup
+        :return: generator of routing query events {"ID": , "Type": , "Responses": , "Extra": }
+        """
+        args = [('arg', cid), ('verbose', 'true')]
+        if timeout is not None:
+            args.append(('timeout', f'{timeout}s'))
+        return self.stream('dht/findprovs', args, timeout)
+
+    def findpeer(self, peer, timeout=None):
+        """
+        :param peer: peer ID
+        :param timeout: seconds the node may spend on the lookup
+        :return: list of multiaddr string of the peer
+        """
+        args = [('arg', peer)]
+        if timeout is not None:
+            args.append(('timeout', f'{timeout}s'))
+        addrs = []
+        for event in self.stream('dht/findpeer', args, timeout):
+            if event.get("Type") == FinalPeer:
+                for response in event.get("Responses") or []:
+                    addrs += response.get("Addrs") or []
+        return addrs
+
+    def stats_dht(self):
+        """
+        :return: list of {"Name": dht name, "Buckets": [{"Peers": [{"ID": }]}]}, one per dht
+        """
+        return list(self.stream('stats/dht', []))
+
+
+_local = threading.local()
+
+
+def local_client():
+    """
+    :return: IpfsRpc of the calling thread, created on first use
+    """
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = IpfsRpc()
+        _local.client = client
+    return client
+
+
+def event_text(event, ts=None):
+    """
+    format a routing query event the way `ipfs dht findprovs -v` prints it
+    :param event: event dic
+    :param ts: event time, now if None
+    :return: text lines of the event, empty string for events the cli does not print
+    """
+    if ts is None:
+        ts = datetime.now()
+    prefix = f'{ts.strftime("%H:%M:%S.%f")[:-3]}: '
+    event_type = event.get("Type")
+    responses = event.get("Responses") or []
+    if event_type == SendingQuery:
+        return f'{prefix}* querying {event.get("ID")}\n'
+    elif event_type == PeerResponse:
+        return f'{prefix}* {event.get("ID")} says use ' + ''.join(f'{x["ID"]} ' for x in responses) + '\n'
+    elif event_type == QueryError:
+        return f'{prefix}error: {event.get("Extra")}\n'
+    elif event_type == DialingPeer:
+        return f'{prefix}dialing peer: {event.get("ID")}\n'
+    elif event_type == Provider:
+        text = ''
+        for provider in responses[:1]:
+            text += f'{prefix}provider: {provider["ID"]}\n'
+            for addr in provider.get("Addrs") or []:
+                text += f'\t{addr}\n'
+        return text
+    elif event_type in (FinalPeer, Value, AddingPeer):
+        return ''
+    return f'{prefix}unrecognized event type: {event_type}\n'
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    """
+    stub RPC api serving recorded event streams from a directory:
+    {dir}/findprovs/{cid}.ndjson, {dir}/findpeer/{peer}.ndjson and {dir}/stats_dht.ndjson
+    """
+    protocol_version = 'HTTP/1.1'
+    replay_dir = '.'
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        command = url.path[len('/api/v0/'):]
+        arg = query.get('arg', [''])[0]
+        if command == 'dht/findprovs':
+            path = os.path.join(self.replay_dir, 'findprovs', f'{arg}.ndjson')
+        elif command == 'dht/findpeer':
+            path = os.path.join(self.replay_dir, 'findpeer', f'{arg}.ndjson')
+        elif command == 'stats/dht':
+            path = os.path.join(self.replay_dir, 'stats_dht.ndjson')
+        else:
+            path = None
+        if path is None or not os.path.exists(path):
+            body = json.dumps({"Message": f'no recording for {command} {arg}', "Code": 0, "Type": "error"}).encode()
+            self.send_response(500)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Chunked-Output', '1')
+        self.end_headers()
+        with open(path, 'rb') as stdin:
+            for line in stdin:
+                if replay_delay > 0:
+                    time.sleep(replay_delay)
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def record(directory, all_cid):
+    """
+    save the raw findprovs streams of all cid, the routing table and findpeer of the providers for replay
+    :param directory: output directory
+    :param all_cid: list of cid
+    :return: None
+    """
+    client = IpfsRpc()
+    os.makedirs(os.path.join(directory, 'findprovs'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'findpeer'), exist_ok=True)
+    with open(os.path.join(directory, 'stats_dht.ndjson'), 'w') as fout:
+        for dht in client.stats_dht():
+            fout.write(json.dumps(dht) + '\n')
+    for cid in all_cid:
+        providers = []
+        with open(os.path.join(directory, 'findprovs', f'{cid}.ndjson'), 'w') as fout:
+            for event in client.findprovs(cid):
+                fout.write(json.dumps(event) + '\n')
+                if event.get("Type") == Provider:
+                    providers += [x["ID"] for x in event.get("Responses") or []]
+        for peer in providers:
+            try:
+                events = list(client.stream('dht/findpeer', [('arg', peer)]))
+            except IpfsRpcError as e:
+                print(e)
+                continue
+            with open(os.path.join(directory, 'findpeer', f'{peer}.ndjson'), 'w') as fout:
+                for event in events:
+                    fout.write(json.dumps(event) + '\n')
+    client.close()
+
+
+if __name__ == '__main__':
+    # python ipfs_rpc.py replay <dir> [port]   serve recorded streams as a stub RPC api
+    # python ipfs_rpc.py record <dir> <cid>... record streams of a running node
+    if len(sys.argv) >= 3 and sys.argv[1] == 'replay':
+        ReplayHandler.replay_dir = sys.argv[2]
+        port = int(sys.argv[3]) if len(sys.argv) == 4 else rpc_port
+        server = http.server.ThreadingHTTPServer((rpc_host, port), ReplayHandler)
+        print(f'replaying {sys.argv[2]} on {rpc_host}:{port}')
+        server.serve_forever()
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'record':
+        record(sys.argv[2], sys.argv[3:])
+    else:
+        print('usage: ipfs_rpc.py replay <dir> [port] | record <dir> <cid>...')
@@ -0,0 +1,124 @@
+import heapq
+import json
+import os
+import sys
+
+# columns of an index entry
+QUERIED = 0
+ANSWERED = 1
+LED_TO_PROVIDER = 2
+BUCKETS = 3
+columns = {"queried": QUERIED, "answered": ANSWERED, "led_to_provider": LED_TO_PROVIDER}
+merged_file = "peer_index.json"
+
+
+class PeerIndex:
+    """
+    per peer counts over many lookups: in how many it was queried, answered with closer peers
+    and sat on the path to a provider, with the buckets it was found in.
+    Indexes of different cid, days or vantage points merge by adding up
+    """
+
+    def __init__(self):
+        # {peer ID : [queried, answered, led to provider, {bucket id : lookups}]}
+        self.peers = {}
+        self.lookups = 0
+
+    def _entry(self, peer):
+        entry = self.peers.get(peer)
+        if entry is None:
+            entry = [0, 0, 0, {}]
+            self.peers[peer] = entry
+        return entry
+
+    def add_lookup(self, graph, dht_bucket, result_host_dic):
+        """
+        count one lookup
+        :param graph: QueryGraph of the lookup
+        :param dht_bucket: routing table at lookup time, list of Bucket
+        :param result_host_dic: [provider : which peer responded this provider]
+        :return: None
+        """
+        self.lookups += 1
+        bucket_index = {}
+        for bucket in dht_bucket or []:
+            for peer in bucket.peers:
+                bucket_index.setdefault(peer, str(bucket.id))
+        for peer, query in graph.query_index.items():
+            entry = self._entry(peer)
+            entry[QUERIED] += 1
+            if len(query.answer) > 0:
+                entry[ANSWERED] += 1
+            if peer in bucket_index:
+                buckets = entry[BUCKETS]
+                buckets[bucket_index[peer]] = buckets.get(bucket_index[peer], 0) + 1
+        # peers returning a provider and every query leading to them, each once
+        on_path = set()
+        stack = [graph.query_index[x] for x in set(result_host_dic.values()) if x in graph.query_index]
+        while len(stack) > 0:
+            query = stack.pop()
+            if query.id in on_path:
+                continue
+            on_path.add(query.id)
+            stack += query.parent or []
+        for peer in on_path:
+            self._entry(peer)[LED_TO_PROVIDER] += 1
+
+    def merge(self, other):
+        """
+        add the counts of another index
+        :param other: PeerIndex
+        :return: self
+        """
+        self.lookups += other.lookups
+        for peer, counts in other.peers.items():
+            entry = self._entry(peer)
+            for column in (QUERIED, ANSWERED, LED_TO_PROVIDER):
+                entry[column] += counts[column]
+            for bucket_id, count in counts[BUCKETS].items():
+                entry[BUCKETS][bucket_id] = entry[BUCKETS].get(bucket_id, 0) + count
+        return self
+
+    def top(self, k, by="led_to_provider"):
+        """
+        :param k: number of peers
+        :param by: column to rank by, queried, answered or led_to_provider
+        :return: list of (peer ID, entry) of the k peers with the largest column
+        """
+        column = columns[by]
+        return heapq.nlargest(k, self.peers.items(), key=lambda x: x[1][column])
+
+    def save(self, path):
+        temp = f'{path}.tmp'
+        with open(temp, 'w') as fout:
+            json.dump({"lookups": self.lookups, "peers": self.peers}, fout)
+        os.replace(temp, path)
+
+    @staticmethod
+    def load(path):
+        index = PeerIndex()
+        with open(path, 'r') as stdin:
+            data = json.load(stdin)
+        index.lookups = data["lookups"]
+        index.peers = data["peers"]
+        return index
+
+
+if __name__ == '__main__':
+    # python peer_index.py <index json>... [top=20] [by=led_to_provider]
+    # merge the daily indexes of any vantage point into peer_index.json and print the top peers
+    k = 20
+    by = "led_to_provider"
+    index = PeerIndex()
+    for arg in sys.argv[1:]:
+        if arg.startswith('top='):
+            k = int(arg[4:])
+        elif arg.startswith('by='):
+            by = arg[3:]
+        else:
+            index.merge(PeerIndex.load(arg))
+    index.save(merged_file)
+    print(f'lookups {index.lookups} peers {len(index.peers)}')
+    for peer, entry in index.top(k, by):
+        print(peer, f'queried {entry[QUERIED]} answered {entry[ANSWERED]} '
+                    f'led_to_provider {entry[LED_TO_PROVIDER]} buckets {entry[BUCKETS]}')
@@ -1,17 +1,75 @@
+import asyncio
+import bisect
 import copy
+import heapq
 import ipaddress
 import os
+import socket
+import struct
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import json
 from getpass import getpass
 from json import JSONEncoder
 from typing import Any
+from xml.sax.saxutils import escape
 
 import icmplib
 
+import ipfs_rpc
+from peer_index import PeerIndex
+
+# "cli" runs ../ipfs for every DHT call, "rpc" talks to the daemon RPC api at ipfs_rpc.rpc_host:rpc_port
+dht_backend = "cli"
+# findprovs lookups running at once, and seconds before a lookup is killed
+lookup_parallelism = 8
+lookup_deadline = 300
+# seconds between two routing table snapshots during the lookups
+snapshot_interval = 60
+# peerID -> multi address cache shared by the daily runs, seconds an address lookup stays valid,
+# and seconds before a peer with no route is looked up again
+peer_cache_file = "../peer_cache.json"
+peer_cache_ttl = 86400
+peer_cache_miss_ttl = 3600
+# error text of a findpeer that ran and found no route, other errors are not cached
+routing_not_found = "not found"
+# find_peer_addrs result of a lookup that could not run, daemon down or rpc refused
+LOOKUP_FAILED = "failed"
+# pings per ip, seconds between them and ip pinged at once,
+# then tcp handshakes at once and seconds before one is dropped for ip not answering ping
+ping_count = 5
+ping_interval = 0.2
+ping_concurrency = 64
+tcp_probe_parallelism = 16
+tcp_probe_timeout = 3
+# "ttl" estimates the hop count from the echo reply ttl and only runs traceroute when that is ambiguous,
+# "traceroute" runs it for every address
+hop_mode = "ttl"
+# common initial ttl, and router count from which a ttl estimate is taken as ambiguous
+initial_ttls = (64, 128, 255)
+ttl_max_hops = 32
+# traceroute hop count per /24 prefix shared by the daily runs, and seconds an entry stays valid
+route_cache_file = "../route_cache.json"
+route_cache_ttl = 7 * 86400
+# not exported by the socket module before python 3.12
+IP_RECVTTL = getattr(socket, 'IP_RECVTTL', 12)
+# seconds between two reads at the end of the followed daemon log, and seconds it has to stay quiet
+# after the lookups finished before follow mode stops
+follow_poll = 1.0
+follow_linger = 60
+# slowest answering peers kept per lookup
+slow_peer_count = 10
+# processes analysing the lookups of a day, and directory of the lookup visualizations
+analysis_workers = os.cpu_count() or 1
+visual_dir = "visualization"
+# ip4 ranges of peer addresses left out of the rtt and hop measurement
+private_networks = tuple(ipaddress.IPv4Network(x) for x in
+                         ('10.0.0.0/8', '172.16.0.0/12', '127.0.0.0/8', '192.168.0.0/16'))
+
 
 class Bucket:
     def __init__(self, id):
@@ -27,6 +85,8 @@ class Query:
         self.child = []
         self.uid = uid
         self.parent = None
+        # child index path from the roots, orders queries the way a depth first walk meets them
+        self.walk_key = None
 
 
 class Response:
@@ -52,19 +112,26 @@ class Address:
         self.port = port
         self.protocol = protocol
         self.rtt = None
+        # ttl of the echo reply, the hop count estimate is based on it
+        self.ttl = None
         self.ip_hop = None
 
 
 class Stats:
-    def __init__(self, cid, ipfs_hop, providers):
+    def __init__(self, cid, ipfs_hop, providers, hop_distribution=None, timing=None):
         self.cid = cid
         self.ipfs_hop = ipfs_hop
         self.providers = providers
+        # {provider : {"peer": responding peer, "min_hop": , "max_hop": }}
+        self.hop_distribution = hop_distribution if hop_distribution is not None else {}
+        # lookup_timing output, seconds from the first query to the first provider, added per hop, slowest peers
+        self.timing = timing if timing is not None else {}
 
 
 class StatsEncoder(JSONEncoder):
     def default(self, o: Stats):
-        json_string = o.__dict__
+        # copy, the same Stats is written again in follow mode
+        json_string = dict(o.__dict__)
         providers = json_string['providers']
         providers_new = copy.deepcopy(providers)
         for key in providers.keys():
@@ -73,313 +140,916 @@ class StatsEncoder(JSONEncoder):
         return json_string
 
 
-def add_parent(query_target: Query, q: Query):
+class QueryGraph:
+    """
+    query graph of one DHT lookup, with maps from peer ID to its query and response node
+    so every log line is added in constant time
+    """
+
+    def __init__(self):
+        self.root_query = []
+        self.all_query = []
+        self.all_provider = []
+        self.all_response = []
+        # {peer ID : Query}, the first query of the peer in walk order
+        self.query_index = {}
+        # {peer ID : Response}
+        self.response_index = {}
+        # {peer ID : time of its latest query}, {peer ID : longest seconds from a query to its answer}
+        self.sent = {}
+        self.answer_latency = {}
+        # {peer ID : time of its first answer}
+        self.answer_time = {}
+        self.uid = 0
+
+    def add_query(self, id, ts):
+        """
+        add a "querying" line, the queries whose answer contain the peer become its parents
+        :param id: peer ID queried
+        :param ts: seconds timestamp, None if unknown
+        :return: new Query
+        """
+        q = Query(id, ts, self.uid)
+        self.sent[id] = ts
+        self.uid += 1
+        response = self.response_index.get(id)
+        if response is not None:
+            parents = []
+            for query in response.parent:
+                if query not in parents:
+                    parents.append(query)
+            # same order as a depth first walk from the roots would add them
+            parents.sort(key=lambda x: x.walk_key)
+            for parent in parents:
+                walk_key = parent.walk_key + (len(parent.child),)
+                parent.child.append(q)
+                if q.walk_key is None or walk_key < q.walk_key:
+                    q.walk_key = walk_key
+            q.parent = parents
+        # no parent = root query
+        if q.parent is None:
+            q.walk_key = (len(self.root_query),)
+            self.root_query.append(q)
+        known = self.query_index.get(id)
+        if known is None or q.walk_key < known.walk_key:
+            self.query_index[id] = q
+        self.all_query.append(q)
+        return q
+
+    def add_answer(self, id, peers, ts):
+        """
+        add a "says use" line
+        :param id: peer ID that answered
+        :param peers: closer peer IDs in the answer
+        :param ts: seconds timestamp, None if unknown
+        :return: None
+        """
+        # find original query
+        q = self.query_index.get(id)
+        if q is None:
+            return
+        sent = self.sent.get(id)
+        if ts is not None and sent is not None:
+            self.answer_latency[id] = max(self.answer_latency.get(id, 0), ts - sent)
+        self.answer_time.setdefault(id, ts)
+        for peer in peers:
+            response = self.response_index.get(peer)
+            if response is None:
+                response = Response(peer, ts, self.uid)
+                self.response_index[peer] = response
+                self.all_response.append(response)
+                self.uid += 1
+            response.parent.append(q)
+            q.answer.append(response)
+
+    def add_provider(self, id, ts):
+        """
+        add a "provider:" line
+        :param id: provider peer ID
+        :param ts: seconds timestamp, None if unknown
+        :return: new Provider
+        """
+        provider = Provider(id, ts, self.uid)
+        self.uid += 1
+        self.all_provider.append(provider)
+        return provider
+
+
+def hop_depths(graph: QueryGraph):
     """
-    add parents for q if exist
-    :param query_target: query to check
-    :param q: new query q
-    :return: True if added to at least one node
+    min and max hop depth of every query in one pass over the lookup DAG.
+    Queries are added after all their parents, so all_query is already in topological order
+    :param graph: QueryGraph of the lookup
+    :return: dic {peer ID : (min depth, max depth)} over all queries of the peer
     """
-    for response in query_target.answer:
-        if q.id == response.id:
+    depth = {}
+    peer_depth = {}
+    for query in graph.all_query:
+        # only parents already seen, a malformed log can not loop
+        parents = [depth[parent] for parent in query.parent or [] if parent in depth]
+        if len(parents) > 0:
+            depth[query] = (1 + min(x[0] for x in parents), 1 + max(x[1] for x in parents))
+        else:
+            depth[query] = (1, 1)
+        if query.id in peer_depth:
+            known = peer_depth[query.id]
+            peer_depth[query.id] = (min(known[0], depth[query][0]), max(known[1], depth[query][1]))
+        else:
+            peer_depth[query.id] = depth[query]
+    return peer_depth
+
+
+def iter_dht_buckets(lines):
+    """
+    parse `ipfs stats dht` output as it is read
+    :param lines: iterable of output lines, like an open file
+    :return: generator of Bucket, each yielded once all its peers were read
+    """
+    current_bucket = None
+    for line in lines:
+        if "Bucket" in line:
+            if current_bucket is not None:
+                yield current_bucket
+            line = line.replace(" ", "")
+            index = line.find("Bucket")
             try:
-                # case child exist
-                index = query_target.child.index(q)
+                # deal with 2 digit id
+                bucket_id = int(line[index + 6:index + 8])
             except Exception:
-                # case new child
-                query_target.child.append(q)
-            if q.parent is None:
-                q.parent = [query_target]
+                # case of 1 digit id
+                bucket_id = int(line[index + 6:index + 7])
+            current_bucket = Bucket(bucket_id)
+            continue
+        elif "Peer" in line or "DHT" in line or current_bucket is None:
+            continue
+        else:
+            # bucket reading
+            line = line.split(" ")
+            if len(line) < 5:
+                continue
+            # case we have @ at the output
+            if line[2] == "@":
+                current_bucket.peers.append(line[3])
+            elif line[4] != "":
+                current_bucket.peers.append(line[4])
+    if current_bucket is not None:
+        yield current_bucket
+
+
+def parse_dht_dump(lines):
+    """
+    parse `ipfs stats dht` output
+    :param lines: output lines
+    :return: list of Bucket
+    """
+    return list(iter_dht_buckets(lines))
+
+
+class LookupEvent:
+    """
+    one line of `ipfs dht findprovs -v` output
+    """
+    QUERY = "querying"
+    ANSWER = "says"
+    PROVIDER = "provider"
+
+    def __init__(self, kind, ts, peer, peers=None):
+        self.kind = kind
+        # seconds, None if the line had no clock
+        self.ts = ts
+        # peer queried, peer that answered or provider found
+        self.peer = peer
+        # closer peers of an answer
+        self.peers = peers if peers is not None else []
+
+
+def parse_clock(ts):
+    """
+    :param ts: "HH:MM:SS.mmm" timestamp of a findprovs line
+    :return: seconds since midnight, None if ts is not a clock
+    """
+    try:
+        hours, minutes, seconds = ts.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def iter_lookup_events(lines):
+    """
+    parse `ipfs dht findprovs -v` output as it is read
+    :param lines: iterable of output lines, like an open file
+    :return: generator of LookupEvent, error and address lines are skipped.
+             Timestamps are seconds from the midnight before the lookup, growing past 86400 after midnight
+    """
+    # seconds added once the clock wrapped at midnight, and the last timestamp
+    day = 0
+    last = None
+    for line in lines:
+        if line[:1] == '\t':
+            continue
+        clock, _, line = line.partition(": ")
+        ts = parse_clock(clock)
+        if ts is not None:
+            ts += day
+            if last is not None and ts < last - 43200:
+                day += 86400
+                ts += 86400
+            last = ts
+        if line.startswith("* querying "):
+            yield LookupEvent(LookupEvent.QUERY, ts, line[11:].strip())
+        elif line.startswith("* "):
+            # "* <peer> says use <peer> <peer> "
+            words = line.split()
+            if len(words) >= 4 and words[2] == "says":
+                yield LookupEvent(LookupEvent.ANSWER, ts, words[1], words[4:])
+        elif line.startswith("provider: "):
+            yield LookupEvent(LookupEvent.PROVIDER, ts, line[10:].strip())
+
+
+def read_query_graph(path):
+    """
+    :param path: _provid.txt file
+    :return: QueryGraph of the lookup
+    """
+    graph = QueryGraph()
+    with open(path, 'r') as stdin:
+        for event in iter_lookup_events(stdin):
+            if event.kind == LookupEvent.QUERY:
+                graph.add_query(event.peer, event.ts)
+            elif event.kind == LookupEvent.ANSWER:
+                graph.add_answer(event.peer, event.peers, event.ts)
             else:
-                q.parent.append(query_target)
-    if len(query_target.child) > 0:
-        for i in query_target.child:
-            add_parent(i, q)
+                graph.add_provider(event.peer, event.ts)
+    return graph
 
 
-def find_query(query_target: Query, id):
-    if query_target.id == id:
-        return query_target
-    else:
-        if len(query_target.child) > 0:
-            for i in query_target.child:
-                answer = find_query(i, id)
-                if answer is not None:
-                    return answer
-        else:
-            return None
-    return None
+class RoutingTableHistory:
+    """
+    routing table snapshots kept as diffs in a json lines file,
+    first line is the full table and every later line only the added / removed peers per bucket
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # snapshot timestamps and the full table at each of them {bucket id : tuple of peers}
+        self.times = []
+        self.tables = []
+        if os.path.exists(path):
+            with open(path, 'r') as stdin:
+                for line in stdin:
+                    self._apply(json.loads(line))
+
+    def _apply(self, record):
+        table = dict(self.tables[-1]) if len(self.tables) > 0 else {}
+        for bucket_id, peers in record.get("removed", {}).items():
+            removed = set(peers)
+            table[int(bucket_id)] = tuple(x for x in table.get(int(bucket_id), ()) if x not in removed)
+        for bucket_id, peers in record.get("added", {}).items():
+            table[int(bucket_id)] = table.get(int(bucket_id), ()) + tuple(peers)
+        # table first, at() may run in another thread while the lookups record
+        self.tables.append({x: y for x, y in table.items() if len(y) > 0})
+        self.times.append(record["ts"])
+
+    def record(self, ts, dht_bucket):
+        """
+        store a snapshot if the table changed since the last one
+        :param ts: snapshot timestamp
+        :param dht_bucket: list of Bucket
+        :return: True if a diff was written
+        """
+        table = {}
+        for bucket in dht_bucket:
+            # wan and lan tables share bucket ids
+            if len(bucket.peers) > 0:
+                table[bucket.id] = table.get(bucket.id, ()) + tuple(bucket.peers)
+        last = self.tables[-1] if len(self.tables) > 0 else {}
+        added = {}
+        removed = {}
+        for bucket_id in set(table) | set(last):
+            new = table.get(bucket_id, ())
+            old = last.get(bucket_id, ())
+            if new == old:
+                continue
+            old_set = set(old)
+            new_set = set(new)
+            if len(new_set - old_set) > 0:
+                added[bucket_id] = [x for x in new if x not in old_set]
+            if len(old_set - new_set) > 0:
+                removed[bucket_id] = [x for x in old if x not in new_set]
+        if len(self.tables) > 0 and len(added) == 0 and len(removed) == 0:
+            return False
+        record = {"ts": ts, "added": added, "removed": removed}
+        with open(self.path, 'a') as fout:
+            fout.write(json.dumps(record) + '\n')
+        self._apply(record)
+        return True
+
+    def at(self, ts):
+        """
+        :param ts: timestamp
+        :return: list of Bucket of the last snapshot taken at or before ts, the first snapshot if none
+        """
+        if len(self.tables) == 0:
+            return []
+        index = max(bisect.bisect_right(self.times, ts) - 1, 0)
+        dht_bucket = []
+        for bucket_id, peers in sorted(self.tables[index].items()):
+            bucket = Bucket(bucket_id)
+            bucket.peers = list(peers)
+            dht_bucket.append(bucket)
+        return dht_bucket
+
 
+def lookup_timing(graph: QueryGraph, peer_depth):
+    """
+    where the time of a lookup goes
+    :param graph: QueryGraph of the lookup
+    :param peer_depth: hop_depths output
+    :return: dic {"first_provider": seconds from the first query to the first provider, None without provider,
+             "hop_delay": {hop : seconds between the first query of the previous hop and the first of this one},
+             "slowest_peers": [[peer, seconds from its query to its answer]] of the slow_peer_count slowest}
+    """
+    timing = {"first_provider": None, "hop_delay": {}, "slowest_peers": []}
+    sent = [x.create_time for x in graph.all_query if x.create_time is not None]
+    if len(sent) == 0:
+        return timing
+    start = min(sent)
+    found = [x.create_time for x in graph.all_provider if x.create_time is not None]
+    # clock lines have millisecond precision
+    if len(found) > 0:
+        timing["first_provider"] = round(min(found) - start, 3)
+    # {hop : time of its first query}
+    hop_start = {}
+    for query in graph.all_query:
+        if query.create_time is None:
+            continue
+        hop = peer_depth[query.id][0]
+        if hop not in hop_start or query.create_time < hop_start[hop]:
+            hop_start[hop] = query.create_time
+    previous = start
+    for hop in sorted(hop_start):
+        timing["hop_delay"][hop] = round(max(hop_start[hop] - previous, 0), 3)
+        previous = max(previous, hop_start[hop])
+    timing["slowest_peers"] = [[peer, round(latency, 3)] for peer, latency in
+                               heapq.nlargest(slow_peer_count, graph.answer_latency.items(), key=lambda x: x[1])]
+    return timing
 
-def find_depth(node: Query):
+
+def tangled_levels(graph: QueryGraph, dht_bucket, result_host_dic):
     """
-    find the depth of the current node
-    :param node: current node
-    :return: the depth of the node
+    levels of the tangled tree visualization: buckets, the queries of each hop and the providers
+    :param graph: QueryGraph of the lookup
+    :param dht_bucket: routing table at lookup time
+    :param result_host_dic: [provider : which peer responded this provider]
+    :return: list of levels, each a list of {"id": , "parents": []}
     """
-    node = node.parent
-    if node is not None and len(node) > 0:
-        for parent in node:
-            return 1 + find_depth(parent)
-    return 1
+    # peer -> first bucket holding it
+    bucket_index = {}
+    for bucket in dht_bucket:
+        for peer in bucket.peers:
+            bucket_index.setdefault(peer, f'Bucket {bucket.id}')
+    output_list = [[{'id': f'Bucket {bucket.id}'} for bucket in dht_bucket]]
+    level_list = graph.root_query
+    root_level = True
+    while len(level_list) > 0:
+        # {peer : node} already emitted on this level
+        emitted = {}
+        temp_list = []
+        temp_level_list = []
+        for i in level_list:
+            if root_level:
+                parents = [bucket_index[i.id]] if i.id in bucket_index else None
+            else:
+                parents = [x.id for x in i.parent] if i.parent is not None else None
+            # update for existing node
+            if i.id in emitted:
+                emitted[i.id].setdefault('parents', []).extend(parents or [])
+                continue
+            # case for new node
+            peer = {'id': i.id}
+            if parents is not None:
+                peer['parents'] = parents
+            emitted[i.id] = peer
+            temp_list.append(peer)
+            temp_level_list += i.child
+        output_list.append(temp_list)
+        level_list = temp_level_list
+        root_level = False
+    # map final provider to each peer
+    temp_list = []
+    for index, provider in enumerate(graph.all_provider):
+        peer = {'id': f'Provider {index}'}
+        if provider.id in result_host_dic:
+            peer['parents'] = [result_host_dic[provider.id]]
+        temp_list.append(peer)
+    output_list.append(temp_list)
+    return output_list
 
 
-def analyse_ipfs_hops(cid, result_host_dic, visual=False):
+def export_lookup_graph(cid, levels, fmt="json", directory=None):
+    """
+    write the visualization of one lookup into {directory}/{cid}.{fmt}
+    :param cid: cid of the lookup
+    :param levels: tangled_levels output
+    :param fmt: "json" for the tangled tree, "dot" or "graphml"
+    :param directory: output directory, visual_dir if None
+    :return: path written
+    """
+    if directory is None:
+        directory = visual_dir
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{cid}.{fmt}')
+    if fmt == "json":
+        with open(path, 'w') as fout:
+            json.dump(levels, fout)
+        return path
+    # a peer met on several levels is a single node
+    nodes = {}
+    edges = {}
+    for level in levels:
+        for node in level:
+            nodes.setdefault(node['id'], None)
+            for parent in node.get('parents', []):
+                nodes.setdefault(parent, None)
+                edges.setdefault((parent, node['id']), None)
+    with open(path, 'w') as fout:
+        if fmt == "dot":
+            fout.write(f'digraph "{cid}" {{\n')
+            for node in nodes:
+                fout.write(f'  "{node}";\n')
+            for parent, child in edges:
+                fout.write(f'  "{parent}" -> "{child}";\n')
+            fout.write('}\n')
+        elif fmt == "graphml":
+            fout.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                       f'  <graph id="{escape(cid)}" edgedefault="directed">\n')
+            for node in nodes:
+                fout.write(f'    <node id="{escape(node)}"/>\n')
+            for parent, child in edges:
+                fout.write(f'    <edge source="{escape(parent)}" target="{escape(child)}"/>\n')
+            fout.write('  </graph>\n</graphml>\n')
+        else:
+            raise ValueError(f'unknown visualization format {fmt}')
+    return path
+
+
+def analyse_ipfs_hops(cid, result_host_dic, visual=False, dht_bucket=None, peer_index=None):
     """
     analyze how many ipfs hop takes
     :param cid: cid of the object
     :param result_host_dic: a dict contains [provider : which peer responded this provider]
-    :param visual: bool for visualization out put
-    :return: cid and max hop the ipfs query traveled
+    :param visual: False, or the format of the visualization written to visual_dir: "json", "dot", "graphml",
+                   True for "json"
+    :param dht_bucket: routing table at lookup time, read from {cid}_dht.txt if None
+    :param peer_index: PeerIndex to count the lookup into, None to not count
+    :return: cid, max hop the ipfs query traveled to reach a provider,
+             dic {provider : {"peer": responding peer, "min_hop": , "max_hop": }} and lookup_timing output
     """
-    root_query = []
-    all_query = []
-    all_provider = []
-    all_response = []
-    dht_bucket = []
-    uid = 0
-    with open(f'{cid}_dht.txt', 'r') as stdin:
-        bucket_id = 0
-        current_bucket = None
-        for line in stdin.readlines():
-            if "Bucket" in line:
-                line = line.replace(" ", "")
-                index = line.find("Bucket")
-                try:
-                    # deal with 2 digit id
-                    bucket_id = int(line[index + 6:index + 8])
-                except Exception:
-                    # case of 1 digit id
-                    bucket_id = int(line[index + 6:index + 7])
-                current_bucket = Bucket(bucket_id)
-                dht_bucket.append(current_bucket)
-                continue
-            elif "Peer" in line or "DHT" in line:
-                continue
-            else:
-                # bucket reading
-                line = line.split(" ")
-                # case we have @ at the output
-                if line[2] == "@":
-                    # print(line[3])
-                    current_bucket.peers.append(line[3])
-                else:
-                    # print(line[4])
-                    if line[4] != "":
-                        current_bucket.peers.append(line[4])
-
-    with open(f'{cid}_provid.txt', 'r') as stdin:
-        for line in stdin.readlines():
-            if line[0] == '\t':
-                continue
-            line = line.replace("\n", "")
-            index = line.find(": ")
-            ts = line[:index]
-            line = line[index + 1:]
-            line = line.split(" ")
-            if "querying" in line:
-                cid = line[-1]
-                q = Query(cid, ts, uid)
-                uid += 1
-                # find if parent exit or not
-                for i in root_query:
-                    add_parent(i, q)
-                # no parent = root query
-                if q.parent is None:
-                    root_query.append(q)
-                all_query.append(q)
-            elif "says" in line:
-                # case answer
-                res_id = line[line.index("says") - 1]
-                answer_start_index = line.index("use") + 1
-                # find original query
-                q = None
-                for query in root_query:
-                    q = find_query(query, res_id)
-                    if q is not None:
-                        break
-                for index in range(answer_start_index, len(line)):
-                    response = None
-                    for r in all_response:
-                        if r.id == line[index]:
-                            response = r
-                            break
-                    if response is None:
-                        response = Response(line[index], ts, uid)
-                        all_response.append(response)
-                        uid += 1
-                    response.parent.append(q)
-                    q.answer.append(response)
-            elif "provider:" in line:
-                provider = Provider(line[-1], ts, uid)
-                uid += 1
-                all_provider.append(provider)
+    if dht_bucket is None:
+        # per cid dump of older runs
+        with open(f'{cid}_dht.txt', 'r') as stdin:
+            dht_bucket = parse_dht_dump(stdin)
+    graph = read_query_graph(f'{cid}_provid.txt')
+    if peer_index is not None:
+        peer_index.add_lookup(graph, dht_bucket, result_host_dic)
+    peer_depth = hop_depths(graph)
+    timing = lookup_timing(graph, peer_depth)
     # case of no exist
-    if len(all_provider) == 0:
-        return 0
+    if len(graph.all_provider) == 0:
+        return cid, 0, {}, timing
     # map provider and result record, and analyse hop info
-    host_result_dic = dict(zip(result_host_dic.values(), result_host_dic.keys()))
-    max_hop = 0
-    for query in all_query:
-        temp_hop = 0
-        if query.id in host_result_dic.keys():
-            temp_hop = find_depth(query)
-            if temp_hop > max_hop:
-                max_hop = temp_hop
+    hop_distribution = {}
+    for provider, peer in result_host_dic.items():
+        if peer in peer_depth:
+            hop_distribution[provider] = {"peer": peer,
+                                          "min_hop": peer_depth[peer][0],
+                                          "max_hop": peer_depth[peer][1]}
+    # hop count is the shortest path to the peer that returned the provider
+    max_hop = max([x["min_hop"] for x in hop_distribution.values()], default=0)
     # case of visualization file output
     if visual:
-        output_list = []
-        level_list = root_query.copy()
-        # map root to dht bucket:
-        for query in root_query:
-            for bucket in dht_bucket:
-                if query.id in bucket.peers:
-                    query.parent = [f'Bucket {bucket.id}']
-                    break
-        # start to analysis hop information
-        root_level = True
-        while len(level_list) > 0:
-            temp_list = []
-            temp_level_list = []
-            for i in level_list:
-                # update for existing node
-                added = False
-                for j in temp_list:
-                    if j['id'] == i.id:
-                        # if i.parent.id not in j['parents']:
-                        j['parents'] += [x.id for x in i.parent]
-                        added = True
-                        break
-                if added:
-                    continue
-                # case for new node
-                peer = {'id': i.id}
-                if root_level is True:
-                    if i.parent is not None:
-                        peer['parents'] = i.parent
-                else:
-                    if i.parent is not None:
-                        peer['parents'] = [x.id for x in i.parent]
-                temp_list.append(peer)
-                if type(i) == Query:
-                    if len(i.child) > 0:
-                        temp_level_list += i.child
-            output_list.append(temp_list)
-            level_list = temp_level_list
-            root_level = False
-
-        # # read actual peer who provided answer from daemon
-        # with open('daemon.txt', 'r') as stdin:
-        #     result_host_dic = {}
-        #     for line in stdin.readlines():
-        #         if "cid" not in line:
-        #             continue
-        #         index = line.find("cid")
-        #         line = line.replace("\n", "")
-        #         line = line[index:]
-        #         line = line.split(" ")
-        #         result_host_dic[line[5]] = line[3]
-
-        # map final provider to each peer
-        temp_list = []
-        for index in range(len(all_provider)):
-            provider = all_provider[index]
-            peer = {'id': f'Provider {index}',
-                    # 'parents': []}
-                    'parents': [result_host_dic[provider.id]]}
-            temp_list.append(peer)
-        output_list.append(temp_list)
-        # adding bucket into output
-        temp_list = []
-        for bucket in dht_bucket:
-            peer = {'id': f'Bucket {bucket.id}'}
-            temp_list.append(peer)
-        output_list.insert(0, temp_list)
+        export_lookup_graph(cid, tangled_levels(graph, dht_bucket, result_host_dic),
+                            "json" if visual is True else visual)
+    return cid, max_hop, hop_distribution, timing
 
-        with open('visualization/node_modules/@nitaku/tangled-tree-visualization-ii/data.json', 'w') as fout:
-            json.dump(output_list, fout)
-    return cid, max_hop
 
+def hop_task(task):
+    """
+    analyse_ipfs_hops of one cid in a worker process
+    :param task: (cid, result_host_dic, dht_bucket, visual, index the peers or not)
+    :return: analyse_ipfs_hops result and the PeerIndex of the lookup, None if not indexed
+    """
+    cid, result_host_dic, dht_bucket, visual, index = task
+    peer_index = PeerIndex() if index else None
+    try:
+        return analyse_ipfs_hops(cid, result_host_dic, visual, dht_bucket, peer_index), peer_index
+    except OSError as e:
+        # lookup output missing
+        print(f'{cid} {e}')
+        return (cid, 0, {}, {}), None
 
-def get_ip_hop(address: Address):
+
+def analyse_all_hops(cids, all_provider_dic, history, lookup_ts, visual=False, workers=None, peer_indexes=None):
     """
-    find ip hop value from given Address
+    analyse_ipfs_hops of many cid on all cores
+    :param cids: list of cid
+    :param all_provider_dic: {cid : result_host_dic}
+    :param history: RoutingTableHistory of the day
+    :param lookup_ts: dic {cid : lookup start time}, cid without one read their {cid}_dht.txt
+    :param visual: visualization format, see analyse_ipfs_hops
+    :param workers: worker processes, analysis_workers if None
+    :param peer_indexes: dic {cid : PeerIndex of its lookup} to fill, None to not index the peers
+    :return: dic {cid : (cid, max hop, hop_distribution, timing)} in cids order
+    """
+    if workers is None:
+        workers = analysis_workers
+    tasks = [(cid, all_provider_dic[cid], history.at(lookup_ts[cid]) if cid in lookup_ts else None, visual,
+              peer_indexes is not None) for cid in cids]
+    if workers <= 1 or len(tasks) <= 1:
+        results = [hop_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(hop_task, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    all_hops = {}
+    for task, (result, peer_index) in zip(tasks, results):
+        all_hops[task[0]] = result
+        if peer_index is not None:
+            peer_indexes[task[0]] = peer_index
+    return all_hops
+
+
+def traceroute_hop(address: Address):
+    """
+    run traceroute to address
     :param address: Address object
-    :return: None
+    :return: hop count string of the last traceroute line, None if it could not be read
     """
-    if address.ip_type == 'ip6' or address.protocol == 'dns':
-        return
-        # try to use traceroute to get rtt
     if address.protocol == 'tcp':
         protocol = "-T"
     else:
         protocol = '-U'
     # try traceroute
-    process = subprocess.Popen(
-        ['sudo', 'traceroute', address.ip, protocol, '-p', address.port, '-m', '100'],
-        stdout=subprocess.PIPE)
-    line = process.stdout.readlines()[-1]
+    try:
+        process = subprocess.Popen(
+            ['sudo', 'traceroute', address.ip, protocol, '-p', address.port, '-m', '100'],
+            stdout=subprocess.PIPE)
+    except OSError as e:
+        print(e)
+        return None
+    lines = process.stdout.readlines()
+    process.wait()
+    if len(lines) == 0:
+        # traceroute could not resolve or reach the address
+        return None
+    line = lines[-1]
     try:
         line = line.decode('utf-8')
         line = line.replace("\n", "")
         line = line.lstrip()
         print(line)
-        address.ip_hop = line.split(" ")[0]
+        return line.split(" ")[0]
     except Exception:
         print(line)
+        return None
 
 
-def get_rtt(address: Address):
+def hop_from_ttl(ttl):
     """
-    find rtt value from given Address
-    :param address: Address object
+    estimate the path length from the ttl of a reply, assuming the sender started from the
+    closest common initial ttl above it
+    :param ttl: ttl of the reply, None if there was no reply
+    :return: hop count, None if ambiguous
+    """
+    if ttl is None:
+        return None
+    for initial in initial_ttls:
+        if ttl <= initial:
+            routers = initial - ttl
+            if routers >= ttl_max_hops:
+                # as likely a long path as a sender with an unusual initial ttl
+                return None
+            # traceroute counts the destination as a hop
+            return routers + 1
+    return None
+
+
+def route_prefix(ip_value):
+    """
+    :param ip_value: ip4 address string, get_ip_hop skips ip6
+    :return: /24 network of the ip, sharing the route in the cache
+    """
+    return str(ipaddress.ip_network(f'{ip_value}/24', strict=False))
+
+
+class RouteCache:
+    """
+    traceroute hop count per /24 prefix kept across runs in a json file,
+    an entry is measured again once older than route_cache_ttl
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else route_cache_file
+        # {prefix : {"ts": traceroute time, "hop": hop count string}}
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as stdin:
+                    self.entries = json.load(stdin)
+            except ValueError:
+                print(f'ignore broken {self.path}')
+
+    def get(self, prefix, now):
+        entry = self.entries.get(prefix)
+        if entry is None or now - entry["ts"] >= route_cache_ttl:
+            return None
+        return entry["hop"]
+
+    def put(self, prefix, hop, now):
+        self.entries[prefix] = {"ts": now, "hop": hop}
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w') as fout:
+            json.dump(self.entries, fout)
+        os.replace(temp, self.path)
+
+
+def get_ip_hop(address: Address, route_cache: RouteCache = None):
+    """
+    find ip hop value from given Address
+    :param address: Address object, with the reply ttl of measure_rtts in "ttl" mode
+    :param route_cache: RouteCache for the traceroute results of ip4, None to always traceroute.
+                        dns4, dns6 and dnsaddr hosts are traced without the cache
     :return: None
     """
-    if address.ip_type == 'ip6':
+    if address.ip_type == 'ip6' or address.protocol == 'dns':
+        return
+    if hop_mode == "ttl":
+        hop = hop_from_ttl(address.ttl)
+        if hop is not None:
+            address.ip_hop = str(hop)
+            return
+    if route_cache is None or address.ip_type != 'ip4':
+        address.ip_hop = traceroute_hop(address)
         return
+    now = time.time()
+    prefix = route_prefix(address.ip)
+    hop = route_cache.get(prefix, now)
+    if hop is None:
+        hop = traceroute_hop(address)
+        if hop is not None:
+            route_cache.put(prefix, hop, now)
+    address.ip_hop = hop
+
+
+def reply_ttl(ip):
+    """
+    send one echo request on an unprivileged icmp socket and read the ttl of the reply,
+    icmplib does not expose it
+    :param ip: ip4 address
+    :return: ttl of the echo reply, None without reply or icmp socket permission
+    """
     try:
-        host = icmplib.ping(address.ip, count=5, interval=0.2, privileged=False)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except OSError:
+        return None
+    with sock:
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, IP_RECVTTL, 1)
+            sock.settimeout(tcp_probe_timeout)
+            sock.connect((ip, 0))
+            # echo request, the kernel sets the identifier and checksum
+            sock.send(struct.pack('!BBHHH', 8, 0, 0, 0, 1))
+            while True:
+                data, ancdata, _, _ = sock.recvmsg(1024, socket.CMSG_SPACE(4))
+                # skip anything but an echo reply
+                if len(data) == 0 or data[0] != 0:
+                    continue
+                for level, kind, value in ancdata:
+                    if level == socket.IPPROTO_IP and kind == socket.IP_TTL:
+                        return int.from_bytes(value[:4], sys.byteorder)
+                return None
+        except OSError:
+            return None
+
+
+async def tcp_rtt(ip, port, semaphore):
+    """
+    time a tcp handshake with ip:port
+    :param ip: ip4 address
+    :param port: port string
+    :param semaphore: bounds the probes running at once
+    :return: rtt in ms, None if the connection failed
+    """
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, int(port)), timeout=tcp_probe_timeout)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return None
+        rtt = (time.monotonic() - start) * 1000
+        writer.close()
+        return rtt
+
+
+async def measure_ips(targets):
+    """
+    ping every ip at once, tcp probe the ones not answering,
+    then read the reply ttl of the ones answering in "ttl" hop mode
+    :param targets: dic {ip : port to tcp probe}
+    :return: dic {ip : {"rtt": rtt in ms or None, "ttl": reply ttl or None}}
+    """
+    ips = list(targets.keys())
+    rtts = {ip: None for ip in ips}
+    try:
+        hosts = await icmplib.async_multiping(ips, count=ping_count, interval=ping_interval,
+                                              concurrent_tasks=ping_concurrency, privileged=False)
+        for host in hosts:
+            if host.is_alive:
+                rtts[host.address] = host.avg_rtt
+                print(host.address, host.rtts)
     except Exception as e:
         print(e)
-        return
-    if host.is_alive:
-        address.rtt = host.avg_rtt
-        print(host.rtts)
-    else:
-        # try to use traceroute to get rtt
-        process = subprocess.Popen(
-            ['sudo', 'traceroute', address.ip, '-T', '-p', address.port, '-m', '100'],
-            stdout=subprocess.PIPE)
-        line = process.stdout.readlines()[-1]
+    silent = [ip for ip in ips if rtts[ip] is None]
+    semaphore = asyncio.Semaphore(tcp_probe_parallelism)
+    results = await asyncio.gather(*[tcp_rtt(ip, targets[ip], semaphore) for ip in silent])
+    for ip, rtt in zip(silent, results):
+        rtts[ip] = rtt
+    ttls = {}
+    if hop_mode == "ttl":
+        alive = [ip for ip in ips if ip not in silent]
+        # reply_ttl blocks on its socket, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(ping_concurrency) as executor:
+            results = await asyncio.gather(*[loop.run_in_executor(executor, reply_ttl, ip) for ip in alive])
+        ttls = dict(zip(alive, results))
+    return {ip: {"rtt": rtts[ip], "ttl": ttls.get(ip)} for ip in ips}
+
+
+def measure_rtts(addresses, cache_path=None):
+    """
+    fill the rtt and reply ttl of every ip4 address, each distinct ip measured once
+    :param addresses: list of Address
+    :param cache_path: json file {ip : {"rtt": , "ttl": }} of ip already measured, None for no cache
+    :return: None
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as stdin:
+            cache = json.load(stdin)
+    # {ip : port}, the first port seen is the one tcp probed
+    targets = {}
+    for address in addresses:
+        if address.ip_type == 'ip4' and address.ip not in cache and address.ip not in targets:
+            targets[address.ip] = address.port
+    if len(targets) > 0:
+        cache.update(asyncio.run(measure_ips(targets)))
+        if cache_path is not None:
+            with open(cache_path, 'w') as fout:
+                json.dump(cache, fout)
+    for address in addresses:
+        if address.ip_type == 'ip4' and address.ip in cache:
+            address.rtt = cache[address.ip]["rtt"]
+            address.ttl = cache[address.ip]["ttl"]
+
+
+def get_rtt(address: Address):
+    """
+    find rtt value from given Address
+    :param address: Address object
+    :return: None
+    """
+    measure_rtts([address])
+
+
+def find_peer_addrs(peer):
+    """
+    look up the multi addresses of one peer
+    :param peer: peerID
+    :return: list of multi address string, None if no route was found, LOOKUP_FAILED if the lookup could not run
+    """
+    if dht_backend == "rpc":
         try:
-            line = line.decode('utf-8')
-            line = line.replace("\n", "")
-            line = line.split(" ")
-            rtt = float(line[line.index("ms") - 1])
-            address.rtt = str(rtt)
-        except Exception:
-            print(line)
+            addrs = ipfs_rpc.local_client().findpeer(peer, timeout=lookup_deadline)
+        except ipfs_rpc.IpfsRpcError as e:
+            if routing_not_found in str(e):
+                return None
+            print(e)
+            return LOOKUP_FAILED
+        except OSError as e:
+            print(e)
+            return LOOKUP_FAILED
+        # the stream ends without a final peer when the routing gave up
+        return addrs if len(addrs) > 0 else None
+    try:
+        process = subprocess.Popen(['../ipfs', 'dht', 'findpeer', peer],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        print(e)
+        return LOOKUP_FAILED
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        error = stderr.decode('utf-8', 'replace')
+        # case of no route find
+        if routing_not_found in error:
+            return None
+        print(f'findpeer {peer} {error.strip()}')
+        return LOOKUP_FAILED
+    return [line for line in stdout.decode('utf-8').split("\n") if line != '']
 
 
-def get_peer_ip(result_host_dic: dict):
+class PeerCache:
+    """
+    peerID -> multi address cache kept across runs in a json file,
+    an entry is looked up again once older than peer_cache_ttl (peer_cache_miss_ttl for no route)
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else peer_cache_file
+        # {peerID : {"ts": lookup time, "addrs": multi address list or None for no route}}
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as stdin:
+                    self.entries = json.load(stdin)
+            except ValueError:
+                print(f'ignore broken {self.path}')
+
+    def fresh(self, peer, now):
+        entry = self.entries.get(peer)
+        if entry is None:
+            return False
+        ttl = peer_cache_ttl if entry["addrs"] is not None else peer_cache_miss_ttl
+        return now - entry["ts"] < ttl
+
+    def resolve(self, peers, now=None):
+        """
+        look up every peer missing or expired in the cache, each once and lookup_parallelism at once.
+        A failed lookup is not cached, the peer stays missing or keeps its expired entry
+        :param peers: iterable of peerID, may repeat
+        :param now: current timestamp
+        :return: number of peer looked up
+        """
+        if now is None:
+            now = time.time()
+        missing = list(dict.fromkeys(x for x in peers if not self.fresh(x, now)))
+        if len(missing) == 0:
+            return 0
+        with ThreadPoolExecutor(lookup_parallelism) as executor:
+            for peer, addrs in zip(missing, executor.map(find_peer_addrs, missing)):
+                if addrs is not LOOKUP_FAILED:
+                    self.entries[peer] = {"ts": now, "addrs": addrs}
+        self.save()
+        return len(missing)
+
+    def addrs(self, peer):
+        """
+        :param peer: peerID
+        :return: multi address list of peer, None for no route or a failed lookup, resolved first if not cached
+        """
+        if peer not in self.entries:
+            self.resolve([peer])
+        entry = self.entries.get(peer)
+        return entry["addrs"] if entry is not None else None
+
+    def save(self):
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w') as fout:
+            json.dump(self.entries, fout)
+        os.replace(temp, self.path)
+
+
+def is_private(ip_value):
+    """
+    :param ip_value: ip4 address string
+    :return: True for private and loop back ip4
+    """
+    ip = ipaddress.ip_address(ip_value)
+    return any(ip in network for network in private_networks)
+
+
+def get_peer_ip(result_host_dic: dict, cache: PeerCache = None):
     """
     find peer multi address based on peerID
     :param result_host_dic: [provider_peerID : who provides (peerID)]
+    :param cache: PeerCache to look peers up in, one on peer_cache_file if None
     :return: dic {provider_peerID : Address[]}
     """
+    if cache is None:
+        cache = PeerCache()
+    cache.resolve(result_host_dic.keys())
     provider_ip = {}
     for peer in result_host_dic.keys():
-        process = subprocess.Popen(['../ipfs', 'dht', 'findpeer', peer], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # case of no route find
-        for line in process.stderr.readlines():
-            if str(line) != '':
-                provider_ip[peer] = []
-                break
-
-        for line in process.stdout.readlines():
-            line = line.decode('utf-8')
-            line = line.replace("\n", "")
+        lines = cache.addrs(peer)
+        if lines is None:
+            # case of no route find
+            provider_ip[peer] = []
+            continue
+        for line in lines:
             line = line.split("/")
+            if len(line) < 5:
+                # dns or circuit address without port
+                continue
             ip_type = line[1]
             ip_value = line[2]
             protocol = line[3]
@@ -389,10 +1059,7 @@ def get_peer_ip(result_host_dic: dict):
                 continue
             elif ip_type == 'ip4':
                 # exclude private ip address
-                if ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('10.0.0.0/8') or \
-                        ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('172.16.0.0/12') or \
-                        ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('127.0.0.0/8') or \
-                        ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('192.168.0.0/16'):
+                if is_private(ip_value):
                     continue
             # add valid ip address info
             if peer not in provider_ip.keys():
@@ -402,89 +1069,446 @@ def get_peer_ip(result_host_dic: dict):
     return provider_ip
 
 
-def ips_find_provider(cid):
+async def run_to_file(args, path, timeout=None):
     """
-    call ipfs to find provider for cid specified, and do a DHT dump before finding
+    run command with its stdout streamed into path, kill it after timeout seconds
+    :param args: command and arguments
+    :param path: output file
+    :param timeout: deadline in seconds, lookup_deadline if None
+    :return: None
+    """
+    if timeout is None:
+        timeout = lookup_deadline
+    with open(path, 'w') as stdout:
+        process = await asyncio.create_subprocess_exec(*args, stdout=stdout)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+def rpc_dht_buckets(all_dht):
+    """
+    :param all_dht: stats/dht RPC output, one dic per dht
+    :return: list of Bucket, the same as parse_dht_dump gives for the cli output
+    """
+    dht_bucket = []
+    for dht in all_dht:
+        for bucket_id, item in enumerate(dht.get("Buckets") or []):
+            bucket = Bucket(bucket_id)
+            bucket.peers = [x["ID"] for x in item.get("Peers") or []]
+            dht_bucket.append(bucket)
+    return dht_bucket
+
+
+def rpc_find_provider(cid, deadline):
+    """
+    stream the findprovs events of cid from the RPC api into {cid}_provid.txt in the cli text format
     :param cid: cid to find
+    :param deadline: seconds before the lookup is dropped
     :return: None
     """
+    end = time.monotonic() + deadline
+    client = ipfs_rpc.local_client()
+    with open(f'{cid}_provid.txt', 'w') as fout:
+        try:
+            for event in client.findprovs(cid, timeout=deadline):
+                fout.write(ipfs_rpc.event_text(event))
+                if time.monotonic() > end:
+                    client.close()
+                    break
+        except (ipfs_rpc.IpfsRpcError, OSError) as e:
+            print(f'{cid} {e}')
 
-    with open(f'{cid}_dht.txt', 'w') as stdout:
-        stdout.flush()
+
+async def snapshot_routing_table(history: RoutingTableHistory, stop: asyncio.Event):
+    """
+    take a routing table snapshot every snapshot_interval seconds until stop is set
+    :param history: RoutingTableHistory to record into
+    :param stop: set once the lookups finished
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    # own connection, the lookup workers keep theirs busy
+    client = ipfs_rpc.IpfsRpc(timeout=lookup_deadline) if dht_backend == "rpc" else None
+    while True:
+        if client is not None:
+            try:
+                all_dht = await loop.run_in_executor(None, client.stats_dht)
+                history.record(time.time(), rpc_dht_buckets(all_dht))
+            except (ipfs_rpc.IpfsRpcError, OSError) as e:
+                print(e)
+        else:
+            process = await asyncio.create_subprocess_exec('../ipfs', 'stats', 'dht', stdout=asyncio.subprocess.PIPE)
+            try:
+                stdout, _ = await asyncio.wait_for(process.communicate(), timeout=lookup_deadline)
+                history.record(time.time(), parse_dht_dump(stdout.decode('utf-8').splitlines()))
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
         try:
-            process = subprocess.Popen(['../ipfs', 'stats', 'dht'], stdout=stdout)
-            process.wait(timeout=300)
-        except subprocess.TimeoutExpired:
-            process.kill()
+            await asyncio.wait_for(stop.wait(), timeout=snapshot_interval)
+            break
+        except asyncio.TimeoutError:
+            continue
+    if client is not None:
+        client.close()
+
+
+async def ips_find_provider_async(cid, semaphore, lookup_ts, executor=None, done=None):
+    """
+    call ipfs to find provider for cid specified
+    :param cid: cid to find
+    :param semaphore: bounds the lookups running at once
+    :param lookup_ts: dic {cid : lookup start time} to record into
+    :param executor: worker threads of the rpc backend, each with its own connection
+    :param done: set the cid is added to once its _provid.txt is complete, None to not track
+    :return: None
+    """
+    async with semaphore:
+        lookup_ts[cid] = time.time()
+        if dht_backend == "rpc":
+            await asyncio.get_running_loop().run_in_executor(executor, rpc_find_provider, cid, lookup_deadline)
+        else:
+            await run_to_file(['../ipfs', 'dht', 'findprovs', '-v', cid], f'{cid}_provid.txt')
+        if done is not None:
+            done.add(cid)
+
+
+async def find_all_providers(all_cid, parallelism=None, history=None, lookup_ts=None, done=None):
+    """
+    run provider lookups of all cid, at most parallelism at once, each into its own _provid.txt
+    :param all_cid: list of cid
+    :param parallelism: max lookups at once, lookup_parallelism if None
+    :param history: RoutingTableHistory snapshotted while the lookups run, None for no snapshot
+    :param lookup_ts: dic {cid : lookup start time} to fill, a new one if None
+    :param done: set each cid is added to once its lookup finished, None to not track
+    :return: dic {cid : lookup start time}
+    """
+    if parallelism is None:
+        parallelism = lookup_parallelism
+    semaphore = asyncio.Semaphore(parallelism)
+    if lookup_ts is None:
+        lookup_ts = {}
+    stop = asyncio.Event()
+    if history is not None:
+        snapshot = asyncio.create_task(snapshot_routing_table(history, stop))
+        # first snapshot before any lookup
+        while len(history.tables) == 0 and not snapshot.done():
+            await asyncio.sleep(0.1)
+    executor = ThreadPoolExecutor(parallelism) if dht_backend == "rpc" else None
+    await asyncio.gather(*[ips_find_provider_async(cid, semaphore, lookup_ts, executor, done) for cid in all_cid])
+    if executor is not None:
+        executor.shutdown()
+    if history is not None:
+        stop.set()
+        await snapshot
+    return lookup_ts
+
+
+def ips_find_provider(cid):
+    """
+    call ipfs to find provider for cid specified, and do a DHT dump into {cid}_dht.txt before finding
+    :param cid: cid to find
+    :return: None
+    """
+    async def find():
+        await run_to_file(['../ipfs', 'stats', 'dht'], f'{cid}_dht.txt')
+        await run_to_file(['../ipfs', 'dht', 'findprovs', '-v', cid], f'{cid}_provid.txt')
+
+    asyncio.run(find())
+
+
+def parse_daemon_line(line):
+    """
+    parse a provider line of the daemon log
+    :param line: log line
+    :return: (cid, provider peerID, peerID that returned the provider), None for any other line
+    """
+    if "cid" not in line:
+        return None
+    index = line.find("cid")
+    line = line.replace("\n", "")
+    line = line[index:]
+    line = line.split(" ")
+    if len(line) < 6:
+        return None
+    return line[1], line[5], line[3]
+
+
+class DaemonLog:
+    """
+    daemon log reader resuming from a saved byte offset, with the provider map of the lines read so far
+    saved next to it, so the log is never read twice or held in memory.
+    A log replaced under the same name (rotated or truncated) is read from its start
+    """
+
+    def __init__(self, path, state_path=None):
+        self.path = path
+        self.state_path = state_path if state_path is not None else f'{path}.state.json'
+        self.inode = None
+        self.offset = 0
+        # {cid : {provider : peer that returned the provider}}
+        self.providers = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as stdin:
+                state = json.load(stdin)
+            self.inode = state["inode"]
+            self.offset = state["offset"]
+            self.providers = state["providers"]
 
-    with open(f'{cid}_provid.txt', 'w') as stdout:
-        stdout.flush()
+    def save(self):
+        temp = f'{self.state_path}.tmp'
+        with open(temp, 'w') as fout:
+            json.dump({"inode": self.inode, "offset": self.offset, "providers": self.providers}, fout)
+        os.replace(temp, self.state_path)
+
+    def _open(self):
+        """
+        :return: log file positioned at the saved offset, None if there is no log yet
+        """
         try:
-            process = subprocess.Popen(['../ipfs', 'dht', 'findprovs', '-v', cid], stdout=stdout)
-            process.wait(timeout=300)
-        except subprocess.TimeoutExpired:
-            process.kill()
+            stdin = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        stat = os.fstat(stdin.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # new or truncated log
+            self.inode = stat.st_ino
+            self.offset = 0
+        stdin.seek(self.offset)
+        return stdin
 
+    def lines(self, follow=False, poll=None):
+        """
+        :param follow: keep waiting for new lines at the end of the log
+        :param poll: seconds between two reads at the end of the log, follow_poll if None
+        :return: generator of complete lines, yields None each time it caught up with the log in follow mode
+        """
+        if poll is None:
+            poll = follow_poll
+        stdin = self._open()
+        # last line not yet terminated by the daemon
+        partial = b''
+        while True:
+            if stdin is not None:
+                for line in stdin:
+                    if not line.endswith(b'\n'):
+                        partial += line
+                        break
+                    self.offset += len(partial) + len(line)
+                    yield (partial + line).decode('utf-8', 'replace')
+                    partial = b''
+            if not follow:
+                break
+            # rotated away: the old file is drained, go on with the new one.
+            # Truncated in place, like a daemon restarted with > on the same log: read it again from its start
+            try:
+                stat = os.stat(self.path)
+                truncated = stat.st_ino == self.inode and stat.st_size < self.offset + len(partial)
+                rotated = stdin is None or stat.st_ino != self.inode or truncated
+            except FileNotFoundError:
+                truncated = False
+                rotated = False
+            if truncated:
+                self.offset = 0
+            if rotated:
+                reopened = self._open()
+                if reopened is not None:
+                    if stdin is not None:
+                        stdin.close()
+                    stdin = reopened
+                    partial = b''
+                    continue
+            yield None
+            time.sleep(poll)
+        if stdin is not None:
+            stdin.close()
 
-def main(preload=False):
+    def records(self, follow=False):
+        """
+        :param follow: keep following the log
+        :return: generator of cid whose provider map changed, None each time it caught up in follow mode
+        """
+        for line in self.lines(follow):
+            if line is None:
+                yield None
+                continue
+            record = parse_daemon_line(line)
+            if record is None:
+                continue
+            cid, provider, peer = record
+            self.providers.setdefault(cid, {})[provider] = peer
+            yield cid
 
-    today = datetime.now().date()
-    all_cid = []
-    # start reading all cid
-    if not preload:
-        with open(f'{today}_cid.txt', 'r') as stdin:
-            for line in stdin.readlines():
-                line = line.replace("\n", "")
-                all_cid.append(line)
-                ips_find_provider(line)
 
-    # read daemon log file
-    # {cid : result_host_dic={}}
-    all_provider_dic = {}
+def analyse_cids(cids, all_provider_dic, history, lookup_ts, today, workers=None, peer_indexes=None):
+    """
+    hop, address, rtt and ip hop of each cid
+    :param cids: list of cid to analyse
+    :param all_provider_dic: {cid : result_host_dic}
+    :param history: RoutingTableHistory of the day
+    :param lookup_ts: dic {cid : lookup start time}
+    :param today: run date
+    :param workers: hop analysis processes, analysis_workers if None
+    :param peer_indexes: dic {cid : PeerIndex of its lookup} to fill, None to not index the peers
+    :return: list of Stats in cids order
+    """
     all_stats = []
-    with open(f'{today}_daemon.txt', 'r') as stdin:
-        for line in stdin.readlines():
-            if "cid" not in line:
-                continue
-            index = line.find("cid")
-            line = line.replace("\n", "")
-            line = line[index:]
-            line = line.split(" ")
-            cid = line[1]
-            if cid not in all_provider_dic.keys():
-                result_host_dic = {}
-                all_provider_dic[cid] = result_host_dic
-            else:
-                result_host_dic = all_provider_dic[cid]
-            result_host_dic[line[5]] = line[3]
     # hop
-    for cid in all_provider_dic:
-        _, ipfs_hop = analyse_ipfs_hops(cid, all_provider_dic[cid])
+    all_hops = analyse_all_hops(cids, all_provider_dic, history, lookup_ts, workers=workers, peer_indexes=peer_indexes)
+    # resolve every provider once, popular providers show up for many cid
+    cache = PeerCache()
+    cache.resolve(peer for cid, ipfs_hop, _, _ in all_hops.values() if ipfs_hop != 0
+                  for peer in all_provider_dic[cid])
+    for cid in cids:
+        _, ipfs_hop, hop_distribution, timing = all_hops[cid]
         if ipfs_hop == 0:
             # case of no result find
-            stats = Stats(cid, ipfs_hop, {})
+            stats = Stats(cid, ipfs_hop, {}, timing=timing)
             all_stats.append(stats)
             continue
         print(f'IPFS_HOP {ipfs_hop}')
-        providers = get_peer_ip(all_provider_dic[cid])
-        stats = Stats(cid, ipfs_hop, providers)
+        providers = get_peer_ip(all_provider_dic[cid], cache)
+        stats = Stats(cid, ipfs_hop, providers, hop_distribution, timing)
         all_stats.append(stats)
-        for peer in providers.keys():
+    # rtt of every distinct provider ip at once
+    measure_rtts([address for stats in all_stats for addresses in stats.providers.values()
+                  for address in addresses], f'{today}_rtt.json')
+    route_cache = RouteCache()
+    for stats in all_stats:
+        for peer in stats.providers.keys():
             print(peer)
-            for address in providers[peer]:
-                print(f'Address {address.__dict__}')
-                get_rtt(address)
-                get_ip_hop(address)
+            for address in stats.providers[peer]:
+                try:
+                    get_ip_hop(address, route_cache)
+                except (OSError, ValueError) as e:
+                    # one odd address does not cost the day's summary
+                    print(f'hop {address.ip} {e}')
                 print(f'Address {address.__dict__}')
-    # write to file
+    return all_stats
+
+
+def write_summary(today, all_stats, total_cid, reachable_cid, peer_indexes=None):
     with open(f'{today}_summary.json', 'w') as fout:
         json.dump(all_stats, fout, cls=StatsEncoder)
     with open(f'{today}_stats.txt', 'w') as fout:
-        fout.write(f"total_cid {len(all_cid)} reachable_cid {len(all_provider_dic.keys())}\n")
+        fout.write(f"total_cid {total_cid} reachable_cid {reachable_cid}\n")
+    if peer_indexes is not None:
+        # one lookup per cid, a cid analysed again replaced its earlier count
+        day_index = PeerIndex()
+        for peer_index in peer_indexes.values():
+            day_index.merge(peer_index)
+        day_index.save(f'{today}_peer_index.json')
+
+
+def follow(today, all_cid, history):
+    """
+    run the lookups in the background and analyse each cid as soon as the daemon logged its providers
+    and its lookup finished, until the lookups are over and the log stayed quiet for follow_linger seconds
+    :param today: run date
+    :param all_cid: list of cid to look up
+    :param history: RoutingTableHistory of the day
+    :return: None
+    """
+    lookup_ts = {}
+    done = set()
+
+    def lookups():
+        asyncio.run(find_all_providers(all_cid, history=history, lookup_ts=lookup_ts, done=done))
+        with open(f'{today}_lookup_ts.json', 'w') as fout:
+            json.dump(lookup_ts, fout)
+
+    lookup_thread = threading.Thread(target=lookups)
+    lookup_thread.start()
+    log = DaemonLog(f'{today}_daemon.txt')
+    # {cid : Stats}, in order of first provider line
+    all_stats = {}
+    # {cid : PeerIndex}
+    peer_indexes = {}
+    pending = set(log.providers.keys())
+    quiet_since = None
+    for cid in log.records(follow=True):
+        if cid is not None:
+            pending.add(cid)
+            quiet_since = None
+            continue
+        finished = not lookup_thread.is_alive()
+        ready = [x for x in log.providers if x in pending and (finished or x in done)]
+        if len(ready) > 0:
+            # in process, forking next to the running lookup thread is not safe
+            for stats in analyse_cids(ready, log.providers, history, lookup_ts, today, workers=1,
+                                      peer_indexes=peer_indexes):
+                all_stats[stats.cid] = stats
+            pending.difference_update(ready)
+            # providers first, a crash in between reanalyses instead of losing the cid
+            log.save()
+            write_summary(today, list(all_stats.values()), len(all_cid), len(log.providers), peer_indexes)
+        if finished:
+            if quiet_since is None:
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since > follow_linger:
+                break
+    lookup_thread.join()
+
+
+def main(preload=False, follow_log=False, visual=False):
+
+    today = datetime.now().date()
+    all_cid = []
+    # routing table over the day, and when each lookup started
+    history = RoutingTableHistory(f'{today}_dht_snapshots.jsonl')
+    # start reading all cid
+    if not preload:
+        with open(f'{today}_cid.txt', 'r') as stdin:
+            for line in stdin.readlines():
+                line = line.replace("\n", "")
+                all_cid.append(line)
+        if follow_log:
+            follow(today, all_cid, history)
+            return
+        lookup_ts = asyncio.run(find_all_providers(all_cid, history=history))
+        with open(f'{today}_lookup_ts.json', 'w') as fout:
+            json.dump(lookup_ts, fout)
+    try:
+        with open(f'{today}_lookup_ts.json', 'r') as stdin:
+            lookup_ts = json.load(stdin)
+    except Exception:
+        lookup_ts = {}
+
+    # read daemon log file from where the last run stopped
+    log = DaemonLog(f'{today}_daemon.txt')
+    for _ in log.records():
+        pass
+    log.save()
+    # {cid : result_host_dic={}}
+    all_provider_dic = log.providers
+    if visual:
+        # visualization of every lookup of the day only
+        analyse_all_hops(list(all_provider_dic.keys()), all_provider_dic, history, lookup_ts, visual)
+        return
+    peer_indexes = {}
+    all_stats = analyse_cids(list(all_provider_dic.keys()), all_provider_dic, history, lookup_ts, today,
+                             peer_indexes=peer_indexes)
+    # write to file
+    write_summary(today, all_stats, len(all_cid), len(all_provider_dic.keys()), peer_indexes)
 
 
 if __name__ == '__main__':
+    # python record.py                 look up today's cid, then analyse the daemon log
+    # python record.py follow          analyse the daemon log while the lookups run
+    # python record.py visual [format] write the lookup graph of every cid of today into visual_dir,
+    #                                  format json (tangled tree), dot or graphml
+    # python record.py <any>           analyse the lookups of an earlier run
     preload = False
-    if len(sys.argv) == 2:
+    follow_log = False
+    visual = False
+    if len(sys.argv) == 2 and sys.argv[1] == 'follow':
+        follow_log = True
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'visual':
+        preload = True
+        visual = sys.argv[2] if len(sys.argv) == 3 else "json"
+    elif len(sys.argv) == 2:
         preload = True
-    main(preload)
+    main(preload, follow_log, visual)
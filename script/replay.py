@@ -0,0 +1,252 @@
+import bisect
+import glob
+import heapq
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from record import DaemonLog, QueryGraph, read_query_graph
+
+# strategies swept by default: queries in flight, providers to stop after, seconds before a hedged query (None: off)
+alphas = (1, 3, 5, 10)
+ks = (1, 3, 20)
+hedges = (None, 0.5, 1.0, 2.0)
+# seconds a replayed query waits on a peer that never answered in the trace
+query_timeout = 10.0
+sweep_workers = os.cpu_count() or 1
+sweep_file = "replay_sweep.json"
+
+# event kinds of the simulation
+ANSWER = 0
+HEDGE = 1
+
+
+class LookupTrace:
+    """
+    replayable model of one recorded lookup, peers numbered in the order the real lookup first queried them.
+    That order stands for their distance to the key, the trace does not carry the distances
+    """
+
+    def __init__(self, graph: QueryGraph, result_host_dic=None):
+        """
+        :param graph: QueryGraph of the lookup
+        :param result_host_dic: [provider : which peer responded this provider] from the daemon log,
+                                None to credit each provider to the answer printed closest in time
+        """
+        self.peers = list(dict.fromkeys(query.id for query in graph.all_query))
+        index = {peer: i for i, peer in enumerate(self.peers)}
+        self.seeds = sorted(set(index[query.id] for query in graph.root_query))
+        # seconds from query to answer, None for a peer that never answered
+        self.latency = [graph.answer_latency.get(peer) for peer in self.peers]
+        # closer peers of each answer, only peers the trace queried can be replayed
+        self.closer = []
+        for peer in self.peers:
+            answer = graph.query_index[peer].answer
+            self.closer.append(list(dict.fromkeys(index[x.id] for x in answer if x.id in index)))
+        # distinct providers carried by each answer
+        self.providers = [0] * len(self.peers)
+        answered = sorted((ts, peer) for peer, ts in graph.answer_time.items() if ts is not None)
+        answer_ts = [x[0] for x in answered]
+        # first line of each provider
+        first_seen = {}
+        for provider in graph.all_provider:
+            first_seen.setdefault(provider.id, provider)
+        for provider_id, provider in first_seen.items():
+            peer = None
+            if result_host_dic is not None:
+                peer = result_host_dic.get(provider_id)
+            elif provider.create_time is not None and len(answered) > 0:
+                i = bisect.bisect_left(answer_ts, provider.create_time)
+                near = [x for x in (i - 1, i) if 0 <= x < len(answered)]
+                peer = min((answered[x] for x in near), key=lambda x: abs(x[0] - provider.create_time))[1]
+            if peer in index:
+                self.providers[index[peer]] += 1
+        # time to first provider of the recorded lookup
+        sent = [x.create_time for x in graph.all_query if x.create_time is not None]
+        found = [x.create_time for x in graph.all_provider if x.create_time is not None]
+        self.observed = min(found) - min(sent) if len(sent) > 0 and len(found) > 0 else None
+
+
+def simulate(trace: LookupTrace, alpha, k, hedge=None):
+    """
+    replay one lookup strategy over a trace as a discrete event simulation
+    :param trace: LookupTrace
+    :param alpha: queries in flight
+    :param k: providers found before the lookup stops
+    :param hedge: seconds after which a query still unanswered gets one extra query sent next to it, None for none
+    :return: dic {"first_provider": seconds, "done": seconds to k providers, "queries": sent, "providers": found},
+             times None if never reached
+    """
+    # closest known peers not queried yet
+    candidates = list(trace.seeds)
+    heapq.heapify(candidates)
+    seen = set(candidates)
+    # (time, sequence, kind, peer)
+    events = []
+    answered = set()
+    result = {"first_provider": None, "done": None, "queries": 0, "providers": 0}
+    inflight = 0
+
+    def launch(now):
+        peer = heapq.heappop(candidates)
+        latency = trace.latency[peer]
+        result["queries"] += 1
+        heapq.heappush(events, (now + (latency if latency is not None else query_timeout),
+                                result["queries"], ANSWER, peer))
+        if hedge is not None:
+            heapq.heappush(events, (now + hedge, result["queries"], HEDGE, peer))
+
+    while inflight < alpha and len(candidates) > 0:
+        launch(0)
+        inflight += 1
+    while len(events) > 0:
+        now, _, kind, peer = heapq.heappop(events)
+        if kind == HEDGE:
+            if peer not in answered and len(candidates) > 0:
+                launch(now)
+                inflight += 1
+            continue
+        answered.add(peer)
+        inflight -= 1
+        if trace.latency[peer] is not None:
+            for closer in trace.closer[peer]:
+                if closer not in seen:
+                    seen.add(closer)
+                    heapq.heappush(candidates, closer)
+            result["providers"] += trace.providers[peer]
+            if result["providers"] > 0 and result["first_provider"] is None:
+                result["first_provider"] = now
+            if result["providers"] >= k:
+                result["done"] = now
+                break
+        while inflight < alpha and len(candidates) > 0:
+            launch(now)
+            inflight += 1
+    return result
+
+
+def strategy_key(alpha, k, hedge):
+    return f'alpha={alpha} k={k} hedge={hedge}'
+
+
+def replay_file(task):
+    """
+    replay every strategy of the grid over one trace in a worker process
+    :param task: (_provid.txt path, result_host_dic or None, grid as list of (alpha, k, hedge))
+    :return: (observed time to first provider, {strategy key : simulate result}), None for an unreadable trace
+    """
+    path, result_host_dic, grid = task
+    try:
+        trace = LookupTrace(read_query_graph(path), result_host_dic)
+    except (OSError, UnicodeDecodeError) as e:
+        print(f'{path} {e}')
+        return None
+    return trace.observed, {strategy_key(*x): simulate(trace, *x) for x in grid}
+
+
+def find_traces(paths):
+    """
+    :param paths: _provid.txt files or directories searched recursively
+    :return: list of (_provid.txt path, result_host_dic of the cid or None)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '**', '*_provid.txt'), recursive=True))
+        else:
+            files.append(path)
+    # providers logged by the daemon, per run directory
+    all_providers = {}
+    traces = []
+    for path in files:
+        directory = os.path.dirname(path)
+        if directory not in all_providers:
+            all_providers[directory] = {}
+            for daemon_log in glob.glob(os.path.join(directory, '*_daemon.txt')):
+                # resumes from the saved state of record.py if there is one, nothing is saved back
+                log = DaemonLog(daemon_log)
+                for _ in log.records():
+                    pass
+                all_providers[directory].update(log.providers)
+        cid = os.path.basename(path)[:-len('_provid.txt')]
+        traces.append((path, all_providers[directory].get(cid)))
+    return traces
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(times, total):
+    """
+    :param times: time to first provider of the lookups that found one
+    :param total: lookups replayed
+    :return: dic of success rate and time percentiles
+    """
+    times = sorted(times)
+    return {"lookups": total,
+            "success": len(times) / total if total > 0 else 0,
+            "median": percentile(times, 0.5),
+            "p90": percentile(times, 0.9)}
+
+
+def sweep(paths, grid, workers=None):
+    """
+    replay every trace under paths with every strategy of the grid
+    :param paths: _provid.txt files or directories
+    :param grid: list of (alpha, k, hedge)
+    :param workers: processes, sweep_workers if None
+    :return: dic {"observed": summary, strategy key : summary with mean queries sent}
+    """
+    if workers is None:
+        workers = sweep_workers
+    tasks = [(path, result_host_dic, grid) for path, result_host_dic in find_traces(paths)]
+    observed = []
+    first = {strategy_key(*x): [] for x in grid}
+    queries = {strategy_key(*x): 0 for x in grid}
+    total = 0
+    with Pool(workers) as pool:
+        for result in pool.imap_unordered(replay_file, tasks, chunksize=max(1, len(tasks) // (workers * 8))):
+            if result is None:
+                continue
+            total += 1
+            if result[0] is not None:
+                observed.append(result[0])
+            for key, run in result[1].items():
+                if run["first_provider"] is not None:
+                    first[key].append(run["first_provider"])
+                queries[key] += run["queries"]
+    summary = {"observed": summarize(observed, total)}
+    for key in first:
+        summary[key] = summarize(first[key], total)
+        summary[key]["queries"] = queries[key] / total if total > 0 else 0
+    return summary
+
+
+def parse_values(text, cast):
+    return tuple(None if x == 'none' else cast(x) for x in text.split(','))
+
+
+if __name__ == '__main__':
+    # python replay.py <trace dir or _provid.txt>... [alpha=1,3] [k=1,20] [hedge=none,0.5]
+    # writes the time to first provider of every strategy into replay_sweep.json
+    paths = []
+    grid_alphas, grid_ks, grid_hedges = alphas, ks, hedges
+    for arg in sys.argv[1:]:
+        if arg.startswith('alpha='):
+            grid_alphas = parse_values(arg[6:], int)
+        elif arg.startswith('k='):
+            grid_ks = parse_values(arg[2:], int)
+        elif arg.startswith('hedge='):
+            grid_hedges = parse_values(arg[6:], float)
+        else:
+            paths.append(arg)
+    grid = [(alpha, k, hedge) for alpha in grid_alphas for k in grid_ks for hedge in grid_hedges]
+    summary = sweep(paths, grid)
+    for key, value in summary.items():
+        print(key, value)
+    with open(sweep_file, 'w') as fout:
+        json.dump(summary, fout, indent=2)
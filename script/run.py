@@ -1,15 +1,19 @@
-import copy
+import heapq
+import math
 import time
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import pycurl
-import multiprocessing
-import lockfile
 import subprocess
 import requests
-import io
 import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from store import ResultStore
 
 # query = ["rabbit", "google", "cat", "mouse", "dog", "game", "phone", "jojo", "apple", "app", "india"]
 query = ["music", "movie", "game", "videogame", "minecraft", "cooking", "stream", "classic muisc", "live concert"]
@@ -20,6 +24,50 @@ headers = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36"}
 waittime = 2 * 60
 tmpvideofile = "/tmp/tmpvidfile"
+# optional gateway list overriding the default gateways below
+gateway_file = "gateways.json"
+# historical cid re-probed per day
+revisit_budget = 300
+# base seconds between two checks of a cid, doubled for every consecutive dead check
+revisit_interval = 24 * 60 * 60
+revisit_max_backoff = 32
+# etag / last-modified and body of the last feed responses
+feed_cache_file = "feed_cache.json"
+# partial fetch: stop each probe after this many bytes / seconds of data, None for whole video
+probe_max_bytes = None
+probe_max_time = None
+# seconds between two samples of the transfer timeline
+timeline_interval = 0.5
+# seconds of video the player buffers before it starts / resumes after a stall
+player_startup = 2.0
+player_rebuffer = 2.0
+
+
+class Gateway:
+    def __init__(self, name, url, concurrency=4, timeout=waittime):
+        # name prefix of the result fields, e.g. local -> local_data, local_check_ts
+        self.name = name
+        self.url = url
+        # max transfers in flight
+        self.concurrency = concurrency
+        # seconds without data before a probe is aborted
+        self.timeout = timeout
+
+
+gateways = [Gateway("local", "http://localhost:8080/ipfs/", concurrency=8),
+            Gateway("public", "https://player.d.tube/ipfs/", concurrency=4)]
+
+
+def load_gateways(path=gateway_file):
+    """
+    read gateway list from config file, keep the default gateways if the file not exist
+    :param path: json file [{"name": , "url": , "concurrency": , "timeout": }]
+    :return: list of Gateway
+    """
+    if not os.path.exists(path):
+        return gateways
+    with open(path, 'r') as stdin:
+        return [Gateway(**gateway) for gateway in json.load(stdin)]
 
 
 class Video:
@@ -32,47 +80,85 @@ class Video:
         self.upload_date = str(date_obj.date())
         # query type which we got
         self.category = category
-        self.local_check_ts = None
-        self.public_check_ts = None
-        self.local_data = {}
-        self.public_data = {}
+        # every query type the video showed up in
+        self.tags = [category]
+        # {name}_check_ts and {name}_data for every gateway
+        for gateway in gateways:
+            setattr(self, f'{gateway.name}_check_ts', None)
+            setattr(self, f'{gateway.name}_data', {})
 
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__,
                           sort_keys=True, indent=4)
 
 
-def setwtime(t):
-    lock = lockfile.LockFile("timekeeper.lock")
-    with lock:
-        with open("timekeeper.txt", "w") as f:
-            f.write(str(t))
-
-
-def getwtime():
-    lock = lockfile.LockFile("timekeeper.lock")
-    with lock:
-        with open("timekeeper.txt", "r") as f:
-            return float(f.read())
+def feed_session():
+    """
+    pooled session for the avalon feeds, retry with backoff on connection and server errors
+    :return: requests.Session
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
 
 
-def cidsearch():
+def fetch_feed(session, url, cached):
+    """
+    conditional get of one feed
+    :param session: requests.Session
+    :param url: feed url
+    :param cached: cache entry {"etag": , "last_modified": , "data": } of url, None if not cached
+    :return: feed json data and new cache entry
+    """
+    request_headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+    response = session.get(url, headers=request_headers, timeout=60)
+    if response.status_code == 304 and cached is not None:
+        return cached["data"], cached
+    response.raise_for_status()
+    data = json.loads(response.content)
+    return data, {"etag": response.headers.get("ETag"),
+                  "last_modified": response.headers.get("Last-Modified"),
+                  "data": data}
+
+
+def cidsearch(feeds=None):
     """
-    :param prev: previous cid list
-    :return: stats for daily new video and its cid
+    fetch all feeds at once and merge the videos found in several feeds
+    :param feeds: names of the feeds to fetch, all of them if None
+    :return: stats for daily new video per feed, list of unique Video and list of the feeds that failed
     """
     queries = {"trending": "https://avalon.d.tube/trending",
                "new": "https://avalon.d.tube/new",
                "hot": "https://avalon.d.tube/hot"}
-    stats = {"trending": {"total_video": 0, "youtube": 0, "skynet": 0, "ipfs": 0},
-             "new": {"total_video": 0, "youtube": 0, "skynet": 0, "ipfs": 0},
-             "hot": {"total_video": 0, "youtube": 0, "skynet": 0, "ipfs": 0}}
-    ans = {"trending": [],
-           "new": [],
-           "hot": []}
+    if feeds is not None:
+        queries = {x: y for x, y in queries.items() if x in feeds}
+    stats = {x: {"total_video": 0, "youtube": 0, "skynet": 0, "ipfs": 0} for x in queries}
+    # {cid : Video}, first feed in queries decide the category
+    ans = {}
+    failed = []
+    try:
+        with open(feed_cache_file, 'r') as stdin:
+            cache = json.load(stdin)
+    except Exception as e:
+        cache = {}
+    session = feed_session()
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        futures = {i: pool.submit(fetch_feed, session, queries[i], cache.get(queries[i])) for i in queries}
+    session.close()
     for i in queries:
-        response = requests.get(queries[i], headers=headers)
-        data = json.loads(response.content)
+        try:
+            data, cache[queries[i]] = futures[i].result()
+        except Exception as e:
+            print(f'Error feed {i} {e}')
+            failed.append(i)
+            continue
         # [{json:{files:{}}}]
         for vid in data:
             try:
@@ -91,38 +177,24 @@ def cidsearch():
                 elif "ipfs" in json_obj["files"].keys():
                     try:
                         cid = json_obj["files"]["ipfs"]["vid"]["src"]
-                        new_vid = Video(cid, duration, timestamp, i)
-                        ans[i].append(new_vid)
+                        if cid not in ans:
+                            ans[cid] = Video(cid, duration, timestamp, i)
+                        elif i not in ans[cid].tags:
+                            ans[cid].tags.append(i)
                         stats[i]["ipfs"] += 1
                         # success cast vid and add total count
                         stats[i]["total_video"] += 1
                     except Exception as e:
                         print(f'Error IPFS {json_obj["files"]["ipfs"]}')
-                        # print("hi")
-                        # # fall back to old json format
-                        # cid = json_obj["files"]["ipfs"]["videohash"]
-                        # new_vid = Video(cid, duration, timestamp, i)
-                        # ans[i].append(new_vid)
                 else:
                     print(json_obj["files"].keys())
                     continue
 
             except Exception as e:
                 continue
-    return stats, ans
-
-
-buf = io.BytesIO()
-
-
-def writer(x):
-    l = len(x)
-    #    print ("writer called", l)
-    global buf
-    buf.write(x)
-    if l > 0:
-        setwtime(time.time())
-    return None
+    with open(feed_cache_file, 'w') as fout:
+        json.dump(cache, fout)
+    return stats, list(ans.values()), failed
 
 
 def get_length(filename):
@@ -134,129 +206,489 @@ def get_length(filename):
     return float(result.stdout)
 
 
-def bw(vid: Video, gateway, return_dic):
-    try:
-        url = gateway + vid.cid
+class PlayerBuffer:
+    """
+    player buffer fed by the download as bytes arrive, drained at the video average bitrate.
+    Keeps only counters, no second pass over the data
+    """
+
+    def __init__(self, start, dur):
+        """
+        :param start: monotonic time the request started
+        :param dur: video duration in seconds
+        """
+        self.start = start
+        self.dur = dur
+        # bytes per second of video, None until the file size is known
+        self.bitrate = None
+        # seconds of video downloaded / played
+        self.buffered = 0.0
+        self.played = 0.0
+        self.playing = False
+        self.clock = start
+        self.stall_start = None
+        self.startup_delay = None
+        self.rebuffer_count = 0
+        self.rebuffer_time = 0.0
+
+    def advance(self, now):
+        # play from last update till now, stall once the buffer runs dry
+        if self.playing:
+            if self.played + (now - self.clock) >= self.buffered and self.buffered < self.dur:
+                self.stall_start = self.clock + (self.buffered - self.played)
+                self.played = self.buffered
+                self.playing = False
+                self.rebuffer_count += 1
+            else:
+                self.played = min(self.played + (now - self.clock), self.dur)
+        self.clock = now
+
+    def feed(self, now, received):
+        """
+        :param now: monotonic time of the chunk
+        :param received: total bytes received so far
+        :return: None
+        """
+        if self.bitrate is None:
+            return
+        self.advance(now)
+        self.buffered = min(received / self.bitrate, self.dur)
+        if not self.playing:
+            threshold = player_startup if self.startup_delay is None else player_rebuffer
+            if self.buffered - self.played >= threshold or self.buffered >= self.dur:
+                self.playing = True
+                if self.startup_delay is None:
+                    self.startup_delay = now - self.start
+                else:
+                    self.rebuffer_time += now - self.stall_start
+
+    def finish(self, now):
+        """
+        :param now: monotonic time the download ended
+        :return: dic of startup delay, rebuffer event count and total rebuffer seconds
+        """
+        if self.bitrate is None:
+            return {"startup_delay": None, "rebuffer_count": None, "rebuffer_time": None}
+        self.advance(now)
+        if not self.playing and self.stall_start is not None:
+            # partial fetch ended during a stall
+            self.rebuffer_time += now - self.stall_start
+        return {"startup_delay": self.startup_delay,
+                "rebuffer_count": self.rebuffer_count,
+                "rebuffer_time": self.rebuffer_time}
+
+
+class Probe:
+    """
+    one gateway download, watches its own transfer and aborts it once
+    no byte arrived for timeout seconds. Payload is only counted, never kept
+    """
+
+    def __init__(self, vid: Video, gateway: Gateway):
+        """
+        :param vid: Video to probe
+        :param gateway: Gateway to download from
+        """
+        self.vid = vid
+        self.gateway = gateway
+        self.timeout = gateway.timeout
+        self.stalled = False
+        # partial fetch limit reached
+        self.truncated = False
+        self.received = 0
+        self.start = time.monotonic()
+        self.first_byte = None
+        self.last_byte = self.start
+        # longest silence between two chunks after the first byte
+        self.max_gap = 0
+        # cumulative bytes sampled every timeline_interval, delta encoded
+        self.timeline_ms = []
+        self.timeline_bytes = []
+        self.sample_ms = 0
+        self.sample_bytes = 0
+        # content-length of the last response header, for the player bitrate
+        self.content_length = None
+        self.player = PlayerBuffer(self.start, vid.dur)
+
+        url = gateway.url + vid.cid
         #    url = "http://gateway.ipfs.io/ipfs/" + cid
-        setwtime(time.time())
         print(url)
-        # global buf
-        # buf = io.BytesIO()
-
         c = pycurl.Curl()
         c.setopt(c.URL, url)
         c.setopt(c.VERBOSE, False)
-        c.setopt(c.WRITEFUNCTION, writer)
+        c.setopt(c.WRITEFUNCTION, self.write)
+        c.setopt(c.HEADERFUNCTION, self.header)
         c.setopt(c.FOLLOWLOCATION, 1)
-        c.perform()
-        # with open(tmpvideofile, "wb") as out:
-        #     out.write(buf.getvalue())
-
-        m = {}
-        m["total-time"] = c.getinfo(pycurl.TOTAL_TIME)
-        m["namelookup-time"] = c.getinfo(pycurl.NAMELOOKUP_TIME)
-        m["connect-time"] = c.getinfo(pycurl.CONNECT_TIME)
-        m["pretransfer-time"] = c.getinfo(pycurl.PRETRANSFER_TIME)
-        m["redirect-time"] = c.getinfo(pycurl.REDIRECT_TIME)
-        m["starttransfer-time"] = c.getinfo(pycurl.STARTTRANSFER_TIME)
-        m["length"] = c.getinfo(c.CONTENT_LENGTH_DOWNLOAD)
-
-        # if os.path.getsize(tmpvideofile) != 0:
-        #     length = get_length(tmpvideofile)
-        # else:
-        #     length = 0
-        stall_rate = ((m["total-time"] - m["starttransfer-time"]) - vid.dur) / vid.dur
-        if stall_rate < 0:
-            stall_rate = 0
-
-        data = {
-            "overhead": m["starttransfer-time"],
-            "download_time": (m["total-time"] - m["starttransfer-time"]),
-            "file_size": m["length"],
-            "video_length": vid.dur,
-            "stall_rate": stall_rate,
-            "bandwidth": m["length"] / (m["total-time"] - m["starttransfer-time"])
-        }
-
-        if "local" in gateway:
-            return_dic["local_check_ts"] = time.time()
-            vid.local_check_ts = time.time()
-            vid.local_data = data
-            return_dic['local'] = data
-        else:
-            return_dic["public_check_ts"] = time.time()
-            vid.public_check_ts = time.time()
-            vid.public_data = copy.deepcopy(data)
-            return_dic['public'] = data
-
-        print(vid.cid,
-              "overhead:" + str(m["starttransfer-time"]),
-              "download_time:" + str((m["total-time"] - m["starttransfer-time"])),
-              "file_size:" + str(m["length"]),
-              "video_length:" + str(vid.dur),
-              "stall_rate:" + str(stall_rate),
-              "bw(bits/s):" + str(m["length"] / (m["total-time"] - m["starttransfer-time"])))
-    except Exception as e:
-        print(e)
-        return_dic['error'] = True
-        return
+        c.setopt(c.NOPROGRESS, False)
+        c.setopt(c.XFERINFOFUNCTION, self.progress)
+        self.handle = c
+
+    def write(self, x):
+        #    print ("writer called", len(x))
+        l = len(x)
+        if l > 0:
+            now = time.monotonic()
+            if self.first_byte is None:
+                self.first_byte = now
+                if self.content_length and self.vid.dur > 0:
+                    self.player.bitrate = self.content_length / self.vid.dur
+            elif now - self.last_byte > self.max_gap:
+                self.max_gap = now - self.last_byte
+            self.last_byte = now
+            self.received += l
+            self.sample(now)
+            self.player.feed(now, self.received)
+            if self.limit_reached():
+                # returning a short count makes curl abort the transfer
+                self.truncated = True
+                return 0
+        return None
+
+    def header(self, line):
+        line = line.decode('iso-8859-1').lower()
+        if line.startswith('http/'):
+            # new response after a redirect
+            self.content_length = None
+        elif line.startswith('content-length:'):
+            try:
+                self.content_length = int(line.split(':', 1)[1])
+            except ValueError:
+                pass
+        return None
+
+    def progress(self, dltotal, dlnow, ultotal, ulnow):
+        # called by curl about once a second even while idle, non zero aborts
+        now = time.monotonic()
+        self.sample(now)
+        if now - self.last_byte > self.timeout:
+            self.stalled = True
+            return 1
+        if self.limit_reached():
+            self.truncated = True
+            return 1
+        return 0
+
+    def sample(self, now, final=False):
+        """
+        append a timeline sample if timeline_interval passed since the last one
+        :param now: monotonic timestamp
+        :param final: force a sample for the end of the transfer
+        :return: None
+        """
+        ms = round((now - self.start) * 1000)
+        if ms <= self.sample_ms:
+            return
+        if final or ms - self.sample_ms >= timeline_interval * 1000:
+            self.timeline_ms.append(ms - self.sample_ms)
+            self.timeline_bytes.append(self.received - self.sample_bytes)
+            self.sample_ms = ms
+            self.sample_bytes = self.received
+
+    def timeline(self):
+        """
+        :return: dic of delta encoded sample arrays, sum of the first n entries of
+                 "ms" / "bytes" is the time since start / bytes received at sample n
+        """
+        if self.received > self.sample_bytes:
+            self.sample(self.last_byte, final=True)
+        return {"interval": timeline_interval, "ms": self.timeline_ms, "bytes": self.timeline_bytes}
+
+    def limit_reached(self):
+        if probe_max_bytes is not None and self.received >= probe_max_bytes:
+            return True
+        if probe_max_time is not None and self.first_byte is not None and \
+                time.monotonic() - self.first_byte >= probe_max_time:
+            return True
+        return False
+
+
+def probe_result(probe: Probe):
+    """
+    compute probe data from a finished curl handle
+    :param probe: performed Probe
+    :return: data dic for local_data / public_data
+    """
+    vid = probe.vid
+    c = probe.handle
+    m = {}
+    m["total-time"] = c.getinfo(pycurl.TOTAL_TIME)
+    m["namelookup-time"] = c.getinfo(pycurl.NAMELOOKUP_TIME)
+    m["connect-time"] = c.getinfo(pycurl.CONNECT_TIME)
+    m["pretransfer-time"] = c.getinfo(pycurl.PRETRANSFER_TIME)
+    m["redirect-time"] = c.getinfo(pycurl.REDIRECT_TIME)
+    m["starttransfer-time"] = c.getinfo(pycurl.STARTTRANSFER_TIME)
+    m["appconnect-time"] = c.getinfo(pycurl.APPCONNECT_TIME)
+    m["speed-download"] = c.getinfo(pycurl.SPEED_DOWNLOAD_T)
+    m["size-download"] = c.getinfo(pycurl.SIZE_DOWNLOAD_T)
+    m["num-connects"] = c.getinfo(pycurl.NUM_CONNECTS)
+    m["redirect-count"] = c.getinfo(pycurl.REDIRECT_COUNT)
+    m["response-code"] = c.getinfo(pycurl.RESPONSE_CODE)
+    m["primary-ip"] = c.getinfo(pycurl.PRIMARY_IP)
+    m["length"] = float(c.getinfo(c.CONTENT_LENGTH_DOWNLOAD_T))
+    if m["length"] < 0:
+        # no content-length header
+        m["length"] = float(probe.received)
+    # partial fetch only saw part of the file
+    size = probe.received if probe.truncated else m["length"]
+
+    # if os.path.getsize(tmpvideofile) != 0:
+    #     length = get_length(tmpvideofile)
+    # else:
+    #     length = 0
+    stall_rate = ((m["total-time"] - m["starttransfer-time"]) - vid.dur) / vid.dur
+    if stall_rate < 0:
+        stall_rate = 0
+
+    data = {
+        "overhead": m["starttransfer-time"],
+        "download_time": (m["total-time"] - m["starttransfer-time"]),
+        "file_size": m["length"],
+        "video_length": vid.dur,
+        "stall_rate": stall_rate,
+        "bandwidth": size / (m["total-time"] - m["starttransfer-time"]),
+        "received": probe.received,
+        "partial": probe.truncated,
+        "max_gap": probe.max_gap,
+        "curl": m,
+        "timeline": probe.timeline()
+    }
+    data.update(probe.player.finish(probe.last_byte))
+
+    print(vid.cid,
+          "overhead:" + str(m["starttransfer-time"]),
+          "download_time:" + str((m["total-time"] - m["starttransfer-time"])),
+          "file_size:" + str(m["length"]),
+          "video_length:" + str(vid.dur),
+          "stall_rate:" + str(stall_rate),
+          "bw(bits/s):" + str(data["bandwidth"]),
+          "startup_delay:" + str(data["startup_delay"]),
+          "rebuffer:" + str(data["rebuffer_count"]),
+          "partial:" + str(probe.truncated))
+    return data
+
+
+def store_result(vid: Video, gateway: Gateway, data):
+    """
+    save probe data into vid
+    :param vid: Video probed
+    :param gateway: Gateway probed
+    :param data: probe data, None for failed probe
+    :return: None
+    """
+    setattr(vid, f'{gateway.name}_check_ts', time.time() if data is not None else '')
+    setattr(vid, f'{gateway.name}_data', data)
 
 
-def run_video_test(vid):
-    # start record data
-    default_gw = "http://localhost:8080/ipfs/"
-    dtube_gw = "https://player.d.tube/ipfs/"
-    manager = multiprocessing.Manager()
-    return_dict = manager.dict()
-    x = multiprocessing.Process(target=bw, args=(vid, default_gw, return_dict))
-    setwtime(2147483647)
-    x.start()
-    return_dict['error'] = False
-    time_out = False
-    while x.is_alive():
-        time.sleep(1)
-        if time.time() - getwtime() > waittime:
-            x.terminate()
-            print("local_gw", vid.cid, "timeout")
-            time_out = True
-            vid.local_data = None
-            break
-    x.join()
-    x.terminate()
-    if not time_out:
-        # check if error
-        if return_dict['error']:
-            vid.local_data = None
-            vid.local_check_ts = ''
+def bw(vid: Video, gateway: Gateway):
+    """
+    probe vid on gateway in the current process and store the result
+    :param vid: Video to probe
+    :param gateway: Gateway to download from
+    :return: None
+    """
+    probe = Probe(vid, gateway)
+    c = probe.handle
+    data = None
+    try:
+        try:
+            c.perform()
+        except pycurl.error:
+            # aborted on purpose by a partial fetch
+            if not probe.truncated:
+                raise
+        data = probe_result(probe)
+    except Exception as e:
+        if probe.stalled:
+            print(gateway.name, vid.cid, "timeout")
         else:
-            vid.local_data = return_dict['local']
-            vid.local_check_ts = return_dict['local_check_ts']
-    # public gateway
-    time_out = False
-    return_dict['error'] = False
-    y = multiprocessing.Process(target=bw, args=(vid, dtube_gw, return_dict))
-    setwtime(2147483647)
-    y.start()
-    while y.is_alive():
-        time.sleep(1)
-        if time.time() - getwtime() > waittime:
-            x.terminate()
-            print("public_gw", vid.cid, "timeout")
-            vid.public_data = None
-            time_out = True
-            break
-    y.join()
-    y.terminate()
-    if not time_out:
-        if return_dict['error']:
-            vid.public_data = None
-            vid.public_check_ts = ''
+            print(e)
+    c.close()
+    store_result(vid, gateway, data)
+
+
+class ProbeEngine:
+    """
+    drive many gateway downloads at once from one CurlMulti loop,
+    each gateway limited to its own number of transfers in flight
+    """
+
+    def __init__(self, gateways, on_probe=None):
+        """
+        :param gateways: list of Gateway, each with its own concurrency limit
+        :param on_probe: called with (Video, Gateway, done) as each probe finishes,
+                         done is True for the last queued probe of the Video
+        """
+        self.gateways = gateways
+        self.on_probe = on_probe
+        self.pending = {gateway.name: deque() for gateway in gateways}
+        self.active = {gateway.name: 0 for gateway in gateways}
+        # {Video : probes not finished yet}
+        self.remaining = {}
+        self.multi = pycurl.CurlMulti()
+
+    def add(self, vid: Video, gateway: Gateway):
+        """
+        queue a probe of vid on gateway
+        :param vid: Video to probe
+        :param gateway: Gateway, must be one of gateways
+        :return: None
+        """
+        self.pending[gateway.name].append(vid)
+        self.remaining[vid] = self.remaining.get(vid, 0) + 1
+
+    def add_video(self, vid: Video):
+        """
+        queue vid on every gateway, so its probes run side by side
+        :param vid: Video to probe
+        :return: None
+        """
+        for gateway in self.gateways:
+            self.add(vid, gateway)
+
+    def _fill(self):
+        # start queued probes while gateway has free slot
+        for gateway in self.gateways:
+            queue = self.pending[gateway.name]
+            while queue and self.active[gateway.name] < gateway.concurrency:
+                probe = Probe(queue.popleft(), gateway)
+                probe.handle.probe = probe
+                self.multi.add_handle(probe.handle)
+                self.active[gateway.name] += 1
+
+    def _finish(self, c, error=None):
+        probe = c.probe
+        self.multi.remove_handle(c)
+        self.active[probe.gateway.name] -= 1
+        data = None
+        if error is None or probe.truncated:
+            try:
+                data = probe_result(probe)
+            except Exception as e:
+                print(e)
+        elif probe.stalled:
+            print(probe.gateway.name, probe.vid.cid, "timeout")
         else:
-            vid.public_data = return_dict['public']
-            vid.public_check_ts = return_dict['public_check_ts']
+            print(probe.gateway.name, probe.vid.cid, error)
+        store_result(probe.vid, probe.gateway, data)
+        c.probe = None
+        c.close()
+        self.remaining[probe.vid] -= 1
+        done = self.remaining[probe.vid] == 0
+        if done:
+            del self.remaining[probe.vid]
+        if self.on_probe is not None:
+            self.on_probe(probe.vid, probe.gateway, done)
+
+    def run(self):
+        """
+        perform all queued probes, results are stored in each Video
+        :return: None
+        """
+        self._fill()
+        while any(self.active.values()):
+            while True:
+                ret, num_handles = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                num_q, ok_list, err_list = self.multi.info_read()
+                for c in ok_list:
+                    self._finish(c)
+                for c, errno, errmsg in err_list:
+                    self._finish(c, errmsg)
+                if num_q == 0:
+                    break
+            self._fill()
+            self.multi.select(1.0)
+        self.multi.close()
+
+
+def revisit_interval_of(entry):
+    """
+    seconds between two checks of a cid, dead cid back off exponentially
+    :param entry: all_vid_summary entry of the cid
+    :return: interval in seconds
+    """
+    statuses = [value for key, value in entry.items() if key.endswith("_status")]
+    # old entries have no history, count a dead cid as one failed check
+    fail_streak = entry.get("fail_streak", 0 if any(statuses) else 1)
+    return revisit_interval * min(2 ** fail_streak, revisit_max_backoff)
+
+
+def revisit_due(entry):
+    """
+    :param entry: all_vid_summary entry of the cid
+    :return: timestamp the cid is due for a revisit
+    """
+    return (entry.get("last_check_ts") or 0) + revisit_interval_of(entry)
+
+
+def revisit_priority(entry, now):
+    """
+    priority to re-probe a historical cid
+    :param entry: all_vid_summary entry of the cid
+    :param now: current timestamp
+    :return: priority, higher first, None if the cid is not due yet
+    """
+    interval = revisit_interval_of(entry)
+    waited = now - (entry.get("last_check_ts") or 0)
+    if waited < interval:
+        return None
+    age_days = max((now - entry["ts"]) / (24 * 60 * 60), 1)
+    # overdue first, then flapping and fresh videos
+    return waited / interval * (1 + entry.get("flaps", 0)) / math.sqrt(age_days)
 
-    # print(vid.__dict__)
-    # print(return_dict)
+
+def schedule_revisits(all_vid_summary, skip, budget=revisit_budget, now=None):
+    """
+    pick historical cid to probe today
+    :param all_vid_summary: dic {cid : summary entry}
+    :param skip: cid already probed today
+    :param budget: max cid to pick
+    :param now: current timestamp
+    :return: list of cid, highest priority first
+    """
+    if now is None:
+        now = time.time()
+    due = []
+    for cid, entry in all_vid_summary.items():
+        if cid in skip:
+            continue
+        priority = revisit_priority(entry, now)
+        if priority is not None:
+            due.append((priority, cid))
+    print(f"revisit {min(len(due), budget)} of {len(due)} due cid")
+    return [cid for _, cid in heapq.nlargest(budget, due)]
+
+
+def update_summary(entry, vid: Video, now):
+    """
+    record check result of vid into its all_vid_summary entry
+    :param entry: all_vid_summary entry of the cid
+    :param vid: probed Video
+    :param now: check timestamp
+    :return: None
+    """
+    checked = entry.get("checks", 0) > 0
+    alive = False
+    for gateway in gateways:
+        status = getattr(vid, f"{gateway.name}_data") is not None
+        if status:
+            entry[f"last_{gateway.name}_ts"] = getattr(vid, f"{gateway.name}_check_ts")
+            alive = True
+        if checked and entry.get(f"{gateway.name}_status") != status:
+            entry["flaps"] = entry.get("flaps", 0) + 1
+        entry[f"{gateway.name}_status"] = status
+    entry["fail_streak"] = 0 if alive else entry.get("fail_streak", 0) + 1
+    entry["checks"] = entry.get("checks", 0) + 1
+    entry["last_check_ts"] = now
+
+
+def run_video_test(vid):
+    # start record data on all gateway at once
+    engine = ProbeEngine(gateways)
+    engine.add_video(vid)
+    engine.run()
 
 
 if __name__ == "__main__":
@@ -270,98 +702,108 @@ if __name__ == "__main__":
     # skynet vid count
     # ipfs vid count
     # gateway vs local success count
+    gateways = load_gateways()
+    today = str(datetime.now().date())
 
     # load all vid summary
-    try:
-        with open("all_vid_summary.json", "r") as f:
-            all_vid_summary = json.load(f)
-    except Exception as e:
-        # {"cid":{"type":[], "upload_date":[], "last_check_date":[], "status":[]}}
-        all_vid_summary = {}
-
-    # get daily cid
-    daily_summary, new_videos = cidsearch()
-
-    # test_vid = {'trending': [new_videos['trending'][0]]}
-    # new_videos = test_vid
+    store = ResultStore()
+    if store.is_empty() and os.path.exists("all_vid_summary.json"):
+        # first run on the store, take over the json history
+        print(f'import {store.import_summary("all_vid_summary.json", revisit_due)} cid')
+
+    # get daily cid, or the ones saved by an interrupted run of today.
+    # Feeds that failed in an earlier run of today are fetched again
+    daily_summary = store.summary(today)
+    if daily_summary is None or len(daily_summary.get("failed_feeds", [])) > 0:
+        failed_before = daily_summary["failed_feeds"] if daily_summary is not None else None
+        stats, found_vid_list, failed = cidsearch(failed_before)
+        if daily_summary is None:
+            daily_summary = {}
+        # counters of the feeds fetched now, zero for the ones still failing
+        daily_summary.update(stats)
+        daily_summary["failed_feeds"] = failed
+        if len(failed) > 0:
+            print(f'feeds failed {failed}, fetched again by the next run of {today}')
+        store.put_discovery(today, daily_summary, [(vid.cid, tag, vid.dur, vid.ts)
+                                                   for vid in found_vid_list for tag in vid.tags])
+    else:
+        print(f'resume {today}')
+    # every video discovered today, also by earlier runs
+    videos = {}
+    for cid, category, dur, ts in store.discovered(today):
+        if cid not in videos:
+            videos[cid] = Video(cid, dur, ts, category)
+        elif category not in videos[cid].tags:
+            videos[cid].tags.append(category)
+    new_vid_list = list(videos.values())
+    # {cid : {gateway : (check_ts, data)}} already probed today
+    probed = store.probed(today)
+
+    # test_vid = [new_vid_list[0]]
+    # new_vid_list = test_vid
 
-    # record daily vids
-    for i in new_videos:
-        for vid in new_videos[i]:
-            run_video_test(vid)
     # prev vid data
     vid_list = []
-    new_vid_cid_list = []
-    new_vid_list = []
-    for i in new_videos:
-        vid: Video
-        for vid in new_videos[i]:
-            new_vid_cid_list.append(vid.cid)
-            new_vid_list.append(vid)
-            # add new entry record
-            if vid.cid not in all_vid_summary:
-                all_vid_summary[vid.cid] = {
+    new_vid_cid_list = [vid.cid for vid in new_vid_list]
+
+    # revisits already started today count against the budget, unfinished ones go first
+    revisited = [cid for cid in probed if cid not in new_vid_cid_list]
+    revisit_cids = [cid for cid in revisited if len(probed[cid]) < len(gateways)]
+    due_entries = store.due_entries(time.time())
+    revisit_cids += schedule_revisits(due_entries, set(new_vid_cid_list + revisited),
+                                      budget=max(revisit_budget - len(revisited), 0))
+    # recreate prev vid object due for a revisit
+    for cid in revisit_cids:
+        entry = due_entries.get(cid) or store.entry(cid)
+        if entry is None:
+            # probed today but neither discovered today nor done before, nothing to rebuild it from
+            print(f'skip revisit {cid} without entry')
+            continue
+        dur = entry["dur"]
+        ts = entry["ts"]
+        category = entry["category"]
+        vid = Video(cid, dur, ts, category)
+        vid_list.append(vid)
+
+    def record(vid: Video, gateway: Gateway, done):
+        # save probe result, and the summary row in the same commit once vid is done
+        entry = None
+        next_check = None
+        if done:
+            entry = store.entry(vid.cid)
+            if entry is None:
+                # add new entry record
+                entry = {
                     "category": vid.category,
                     "ts": vid.ts,
-                    "dur": vid.dur,
-                    "last_local_ts": "",
-                    "local_status": True,
-                    "last_public_ts": "",
-                    "public_status": True
+                    "dur": vid.dur
                 }
-            if vid.cid in all_vid_summary:
-                # update check info
-                if vid.local_data is not None:
-                    all_vid_summary[vid.cid]["last_local_ts"] = vid.local_check_ts
-                    all_vid_summary[vid.cid]["local_status"] = True
-                else:
-                    all_vid_summary[vid.cid]["local_status"] = False
-
-                if vid.public_data is not None:
-                    all_vid_summary[vid.cid]["last_public_ts"] = vid.local_check_ts
-                    all_vid_summary[vid.cid]["public_status"] = True
-                else:
-                    all_vid_summary[vid.cid]["public_status"] = False
-
-    # recreate all prev vid object
-    for cid in all_vid_summary:
-        if cid not in new_vid_cid_list:
-            dur = all_vid_summary[cid]["dur"]
-            ts = all_vid_summary[cid]["ts"]
-            category = all_vid_summary[cid]["category"]
-            vid = Video(cid, dur, ts, category)
-            # run data
-            run_video_test(vid)
-            # store info
-            vid_list.append(vid)
-
-    for vid in vid_list:
-        if vid.local_data is not None:
-            all_vid_summary[vid.cid]["last_local_ts"] = vid.local_check_ts
-            all_vid_summary[vid.cid]["local_status"] = True
-        else:
-            all_vid_summary[vid.cid]["local_status"] = False
-
-        if vid.public_data is not None:
-            all_vid_summary[vid.cid]["last_public_ts"] = vid.local_check_ts
-            all_vid_summary[vid.cid]["public_status"] = True
-        else:
-            all_vid_summary[vid.cid]["public_status"] = False
-
-    daily_record_data = vid_list + new_vid_list
-
-    # save all_vid_summary
-    with open('all_vid_summary.json', 'w') as fout:
-        json.dump(all_vid_summary, fout)
-    # save today's record
-    today = datetime.now().date()
-    with open(f'{today}.json', 'x') as fout:
-        json.dump([ob.__dict__ for ob in daily_record_data], fout)
-    # save daily summary
-    with open(f'{today}-summary.json', 'x') as fout:
-        json.dump(daily_summary, fout)
+                for gw in gateways:
+                    entry[f"last_{gw.name}_ts"] = ""
+                    entry[f"{gw.name}_status"] = True
+            update_summary(entry, vid, time.time())
+            next_check = revisit_due(entry)
+        store.add_probe(today, vid.cid, gateway.name, vid.category,
+                        getattr(vid, f"{gateway.name}_check_ts"), getattr(vid, f"{gateway.name}_data"),
+                        entry, next_check)
+
+    # run data for daily and prev vids together, skip probes done before an interruption
+    engine = ProbeEngine(gateways, on_probe=record)
+    for vid in vid_list + new_vid_list:
+        done = probed.get(vid.cid, {})
+        for name, (check_ts, data) in done.items():
+            setattr(vid, f"{name}_check_ts", check_ts)
+            setattr(vid, f"{name}_data", data)
+        for gateway in gateways:
+            if gateway.name not in done:
+                engine.add(vid, gateway)
+    engine.run()
+
+    # save today's record and daily summary for analysis, all_vid_summary.json by `python store.py`
+    store.export(today)
     # save cid to folder
-    daily_cid = [ob.cid for ob in daily_record_data]
+    daily_cid = [ob["cid"] for ob in store.daily_records(today)]
+    store.close()
     with open(f'{today}/{today}_cid.txt', 'w') as fout:
         for cid in daily_cid:
             fout.write(cid + '\n')
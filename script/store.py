@@ -0,0 +1,213 @@
+import json
+import sqlite3
+import sys
+from datetime import datetime
+
+db_file = "results.db"
+
+
+class ResultStore:
+    """
+    sqlite store for probe results, keyed by cid, date and gateway.
+    Probe rows are only appended and each cid has one summary row updated in place,
+    so a run only touches the rows of the cid it probed.
+    Every probe is committed as it finishes, an interrupted run resumes from what is stored
+    """
+
+    def __init__(self, path=db_file):
+        self.conn = sqlite3.connect(path)
+        # fsync every commit, the store is the run journal
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS videos (
+                cid TEXT PRIMARY KEY,
+                next_check REAL,
+                entry TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS videos_next_check ON videos (next_check);
+            CREATE TABLE IF NOT EXISTS probes (
+                date TEXT NOT NULL,
+                cid TEXT NOT NULL,
+                gateway TEXT NOT NULL,
+                category TEXT,
+                check_ts,
+                data TEXT,
+                PRIMARY KEY (date, cid, gateway)
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                date TEXT PRIMARY KEY,
+                summary TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS discovered (
+                date TEXT NOT NULL,
+                cid TEXT NOT NULL,
+                category TEXT NOT NULL,
+                dur,
+                ts,
+                PRIMARY KEY (date, cid, category)
+            );
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM videos LIMIT 1').fetchone() is None
+
+    def import_summary(self, path, next_check=0):
+        """
+        load an all_vid_summary.json written by older runs
+        :param path: all_vid_summary.json path
+        :param next_check: function entry -> next check timestamp, or a constant
+        :return: number of cid imported
+        """
+        with open(path, 'r') as stdin:
+            all_vid_summary = json.load(stdin)
+        with self.conn:
+            for cid, entry in all_vid_summary.items():
+                due = next_check(entry) if callable(next_check) else next_check
+                self.conn.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?)',
+                                  (cid, due, json.dumps(entry)))
+        return len(all_vid_summary)
+
+    def entry(self, cid):
+        """
+        :param cid: cid to look up
+        :return: all_vid_summary entry of cid, None if never seen
+        """
+        row = self.conn.execute('SELECT entry FROM videos WHERE cid = ?', (cid,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def due_entries(self, now):
+        """
+        :param now: current timestamp
+        :return: dic {cid : entry} for cid due for a revisit
+        """
+        rows = self.conn.execute('SELECT cid, entry FROM videos WHERE next_check <= ?', (now,))
+        return {cid: json.loads(entry) for cid, entry in rows}
+
+    def add_probe(self, date, cid, gateway, category, check_ts, data, entry=None, next_check=None):
+        """
+        append one probe result, together with the updated summary row if given
+        :param date: run date string
+        :param cid: probed cid
+        :param gateway: gateway name
+        :param category: category the video was probed under
+        :param check_ts: check timestamp
+        :param data: probe data, None for failed probe
+        :param entry: all_vid_summary entry of cid after its last probe, None to keep the row
+        :param next_check: timestamp the cid is due for a revisit
+        :return: None
+        """
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                              (date, cid, gateway, category, check_ts, json.dumps(data)))
+            if entry is not None:
+                self.conn.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?)',
+                                  (cid, next_check, json.dumps(entry)))
+
+    def probed(self, date):
+        """
+        probes already done on date
+        :param date: run date string
+        :return: dic {cid : {gateway : (check_ts, data)}}
+        """
+        probes = {}
+        for cid, gateway, check_ts, data in self.conn.execute(
+                'SELECT cid, gateway, check_ts, data FROM probes WHERE date = ?', (date,)):
+            probes.setdefault(cid, {})[gateway] = (check_ts, json.loads(data))
+        return probes
+
+    def put_discovery(self, date, summary, videos):
+        """
+        save the daily feed counters and discovered videos in one commit,
+        videos already discovered on date are kept once
+        :param date: run date string
+        :param summary: daily summary dic, with the list of feeds that failed in "failed_feeds"
+        :param videos: list of (cid, category, dur, ts)
+        :return: None
+        """
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO discovered VALUES (?, ?, ?, ?, ?)',
+                                  [(date,) + tuple(video) for video in videos])
+            self.conn.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?)', (date, json.dumps(summary)))
+
+    def discovered(self, date):
+        """
+        :param date: run date string
+        :return: list of (cid, category, dur, ts) in discovery order
+        """
+        return self.conn.execute('SELECT cid, category, dur, ts FROM discovered WHERE date = ? ORDER BY rowid',
+                                 (date,)).fetchall()
+
+    def summary(self, date):
+        row = self.conn.execute('SELECT summary FROM summaries WHERE date = ?', (date,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def daily_records(self, date):
+        """
+        rebuild the daily record list in the {date}.json layout
+        :param date: run date string
+        :return: list of dic, one per probed video
+        """
+        records = {}
+        # {cid : every feed it was discovered in}
+        tags = {}
+        for cid, category, _, _ in self.discovered(date):
+            tags.setdefault(cid, []).append(category)
+        rows = self.conn.execute('SELECT p.cid, p.gateway, p.category, p.check_ts, p.data, v.entry '
+                                 'FROM probes p LEFT JOIN videos v ON p.cid = v.cid '
+                                 'WHERE p.date = ? ORDER BY p.rowid', (date,))
+        for cid, gateway, category, check_ts, data, entry in rows:
+            if cid not in records:
+                entry = json.loads(entry) if entry is not None else {}
+                ts = entry.get("ts", 0)
+                records[cid] = {
+                    "cid": cid,
+                    "dur": entry.get("dur"),
+                    "ts": ts,
+                    "upload_date": str(datetime.fromtimestamp(ts).date()),
+                    "category": category,
+                    "tags": tags.get(cid, [category])
+                }
+            records[cid][f"{gateway}_check_ts"] = check_ts
+            records[cid][f"{gateway}_data"] = json.loads(data)
+        return list(records.values())
+
+    def all_vid_summary(self):
+        """
+        :return: dic {cid : entry} in the all_vid_summary.json layout
+        """
+        return {cid: json.loads(entry) for cid, entry in self.conn.execute('SELECT cid, entry FROM videos')}
+
+    def export(self, date=None):
+        """
+        write the json files analysis.py reads
+        :param date: run date to export {date}.json and {date}-summary.json, None for all_vid_summary.json only
+        :return: None
+        """
+        if date is None:
+            with open('all_vid_summary.json', 'w') as fout:
+                json.dump(self.all_vid_summary(), fout)
+            return
+        with open(f'{date}.json', 'w') as fout:
+            json.dump(self.daily_records(date), fout)
+        summary = self.summary(date)
+        if summary is not None:
+            with open(f'{date}-summary.json', 'w') as fout:
+                json.dump(summary, fout)
+
+
+if __name__ == '__main__':
+    # python store.py [date]  export json files of date, or all_vid_summary.json without date
+    store = ResultStore()
+    if len(sys.argv) == 2:
+        store.export(sys.argv[1])
+    else:
+        store.export()
+    store.close()